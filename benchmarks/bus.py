@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+## D-Bus benchmarks of a running localsettings.
+#
+# localsettings is started under a private dbus-daemon with an empty data
+# directory, with --no-delay, with the default save delay and with --journal,
+# and the following is measured through D-Bus:
+#
+# - AddSettings throughput for batches of new settings;
+# - SetValue and GetValue latency percentiles;
+# - GetItems latency for growing trees, after a change and cached, and of the
+#   pages of GetItemsPaged;
+# - the cost of allocating a VRM instance for a growing number of devices;
+# - how long a save of a single change blocks the mainloop for growing trees;
+# - GetValue / SetValue latency and throughput with concurrent clients.
+#
+# The results are written as JSON, so releases can be compared.
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import dbus
+
+from common import here, localsettings
+
+service = "com.victronenergy.settings"
+InterfaceBusItem = "com.victronenergy.BusItem"
+InterfaceSettings = "com.victronenergy.Settings"
+
+## A private dbus-daemon with localsettings on it.
+class Service:
+	def __init__(self, args):
+		self.dataDir = tempfile.mkdtemp(prefix = "localsettings-bench-")
+		settingsDir = os.path.join(self.dataDir, "settings.d")
+		os.mkdir(settingsDir)
+
+		self.daemon = subprocess.Popen(["dbus-daemon", "--session", "--nofork", "--print-address"],
+										stdout = subprocess.PIPE)
+		self.address = self.daemon.stdout.readline().decode().strip()
+		self.bus = dbus.bus.BusConnection(self.address)
+
+		env = dict(os.environ, DBUS_SESSION_BUS_ADDRESS = self.address)
+		self.process = subprocess.Popen([sys.executable, os.path.join(here, "..", "localsettings.py"),
+										"--path=" + self.dataDir, "--settings-dir=" + settingsDir] + args,
+										env = env, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+		deadline = time.monotonic() + 30
+		while not self.bus.name_has_owner(service):
+			if time.monotonic() > deadline or self.process.poll() is not None:
+				self.stop()
+				raise Exception("localsettings did not start")
+			time.sleep(0.01)
+
+	def call(self, path, interface, method, signature = "", args = ()):
+		return self.bus.call_blocking(service, path, interface, method, signature, args)
+
+	def stop(self):
+		self.process.terminate()
+		self.process.wait()
+		self.bus.close()
+		self.daemon.terminate()
+		self.daemon.wait()
+		shutil.rmtree(self.dataDir)
+
+def percentiles(samples):
+	samples = sorted(samples)
+	def at(p):
+		return samples[min(len(samples) - 1, int(len(samples) * p / 100))] * 1e6
+	return {"count": len(samples), "p50_us": at(50), "p90_us": at(90), "p99_us": at(99), "max_us": samples[-1] * 1e6}
+
+def timed(function, *args):
+	start = time.monotonic()
+	function(*args)
+	return time.monotonic() - start
+
+def addSettings(svc, paths, default = 0):
+	svc.call("/Settings", InterfaceSettings, "AddSettings", "aa{sv}",
+				([{"path": path, "default": default} for path in paths],))
+
+def benchAddSettings(svc, batches, repeat):
+	ret = {}
+	for batch in batches:
+		durations = []
+		for n in range(repeat):
+			paths = ["Add%d_%d/s%d" % (batch, n, i) for i in range(batch)]
+			durations.append(timed(addSettings, svc, paths))
+		best = min(durations)
+		ret[str(batch)] = {"best_ms": best * 1000, "settings_per_s": batch / best}
+	return ret
+
+def benchValues(svc, calls):
+	addSettings(svc, ["Values/s"])
+	path = "/Settings/Values/s"
+	get = [timed(svc.call, path, InterfaceBusItem, "GetValue") for i in range(calls)]
+	set_ = [timed(svc.call, path, InterfaceBusItem, "SetValue", "v", (dbus.Int32(i % 100),)) for i in range(calls)]
+	return {"GetValue": percentiles(get), "SetValue": percentiles(set_)}
+
+def benchGetItems(svc, sizes, repeat, pageSize):
+	ret = {}
+	count = 0
+	addSettings(svc, ["Items/changed"])
+	for size in sizes:
+		while count < size:
+			batch = min(1000, size - count)
+			addSettings(svc, ["Items/g%d/s%d" % (count // 1000, count + i) for i in range(batch)])
+			count += batch
+
+		# Most of the round trip is spent decoding the reply in the client, so
+		# the time localsettings spends is taken from its statistics as well.
+		changed = []
+		server = []
+		for n in range(repeat):
+			svc.call("/Settings/Items/changed", InterfaceBusItem, "SetValue", "v", (dbus.Int32(n + 1),))
+			svc.call("/", InterfaceBusItem, "GetStats", "b", (True,))
+			changed.append(timed(svc.call, "/", InterfaceBusItem, "GetItems"))
+			stats = svc.call("/", InterfaceBusItem, "GetStats", "b", (True,))
+			server.append(stats["Methods"]["GetItems"]["Time"])
+		cached = [timed(svc.call, "/", InterfaceBusItem, "GetItems") for n in range(repeat)]
+		stats = svc.call("/", InterfaceBusItem, "GetStats", "b", (True,))
+		cachedServer = stats["Methods"]["GetItems"]["Time"] / repeat
+
+		pages = []
+		cursor = ""
+		while True:
+			start = time.monotonic()
+			items, cursor = svc.call("/", InterfaceBusItem, "GetItemsPaged", "su", (cursor, pageSize))
+			pages.append(time.monotonic() - start)
+			if not cursor:
+				break
+		stats = svc.call("/", InterfaceBusItem, "GetStats", "b", (False,))
+		ret[str(size)] = {"changed_ms": min(changed) * 1000, "changed_server_ms": min(server),
+							"cached_ms": min(cached) * 1000, "cached_server_ms": cachedServer,
+							"page_max_ms": max(pages) * 1000,
+							"page_server_max_ms": stats["Methods"]["GetItemsPaged"]["MaxTime"]}
+	return ret
+
+## The writer thread writes the settings, but the snapshot of the changes is
+# taken on the mainloop, the time of that is taken from the statistics.
+def benchSaves(svc, sizes, repeat):
+	ret = {}
+	count = 0
+	addSettings(svc, ["Saves/changed"])
+	for size in sizes:
+		while count < size:
+			batch = min(1000, size - count)
+			addSettings(svc, ["Saves/g%d/s%d" % (count // 1000, count + i) for i in range(batch)])
+			count += batch
+
+		svc.call("/", InterfaceBusItem, "Flush")
+		svc.call("/", InterfaceBusItem, "GetStats", "b", (True,))
+		for n in range(repeat):
+			svc.call("/Settings/Saves/changed", InterfaceBusItem, "SetValue", "v", (dbus.Int32(n + 1),))
+			svc.call("/", InterfaceBusItem, "Flush")
+		saves = svc.call("/", InterfaceBusItem, "GetStats", "b", (True,))["Saves"]
+		ret[str(size)] = {"snapshot_ms": saves["SnapshotTime"] / repeat, "snapshot_max_ms": saves["SnapshotMaxTime"],
+							"serialize_ms": saves["SerializeTime"] / repeat}
+	return ret
+
+## All devices ask for the same instance, so every allocation has to find a
+# free one.
+def benchVrmInstances(svc, counts, sample):
+	ret = {}
+	count = 0
+	for target in counts:
+		durations = []
+		while count < target:
+			setting = {"path": "Devices/bench_%d/ClassAndVrmInstance" % count, "default": "battery:1"}
+			durations.append(timed(svc.call, "/Settings", InterfaceSettings, "AddSettings", "aa{sv}", ([setting],)))
+			count += 1
+		ret[str(target)] = percentiles(durations[-sample:])
+	return ret
+
+## Runs in a client process.
+def client(address, calls, index):
+	bus = dbus.bus.BusConnection(address)
+	path = "/Settings/Clients/s%d" % index
+	latencies = []
+	start = time.monotonic()
+	for i in range(calls):
+		latencies.append(timed(bus.call_blocking, service, path, InterfaceBusItem, "GetValue", "", ()))
+		latencies.append(timed(bus.call_blocking, service, path, InterfaceBusItem, "SetValue", "v",
+								(dbus.Int32(i % 100),)))
+	return start, time.monotonic(), latencies
+
+def benchClients(svc, clients, calls):
+	ret = {}
+	context = multiprocessing.get_context("spawn")
+	for count in clients:
+		addSettings(svc, ["Clients/s%d" % i for i in range(count)])
+		with context.Pool(count) as pool:
+			results = pool.starmap(client, [(svc.address, calls, i) for i in range(count)])
+		start = min(result[0] for result in results)
+		end = max(result[1] for result in results)
+		latencies = [latency for result in results for latency in result[2]]
+		ret[str(count)] = dict(percentiles(latencies), calls_per_s = len(latencies) / (end - start))
+	return ret
+
+def run(args, options):
+	svc = Service(options)
+	try:
+		result = {
+			"startup_ms": dict(svc.call("/", InterfaceBusItem, "GetStartupProfile")),
+			"add_settings": benchAddSettings(svc, args.batches, args.repeat),
+			"values": benchValues(svc, args.calls),
+			"vrm_instances": benchVrmInstances(svc, args.devices, args.sample),
+			"clients": benchClients(svc, args.clients, args.calls),
+		}
+	finally:
+		svc.stop()
+
+	# The tree sizes are only right without the settings of the others.
+	svc = Service(options)
+	try:
+		result["get_items"] = benchGetItems(svc, args.sizes, args.repeat, args.page_size)
+	finally:
+		svc.stop()
+
+	svc = Service(options)
+	try:
+		result["saves"] = benchSaves(svc, args.sizes, args.repeat)
+	finally:
+		svc.stop()
+	return result
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--output', default = "bus.json", help = "file to write the results to (default: %(default)s)")
+	parser.add_argument('--mode', choices = ['no-delay', 'default', 'journal'], action = 'append',
+							help = "only run localsettings in this mode")
+	parser.add_argument('--repeat', type = int, default = 5, help = "runs per measurement, the best is reported")
+	parser.add_argument('--calls', type = int, default = 1000, help = "calls per latency measurement")
+	parser.add_argument('--batches', type = int, nargs = '+', default = [10, 100, 1000],
+							help = "AddSettings batch sizes")
+	parser.add_argument('--sizes', type = int, nargs = '+', default = [1000, 5000, 10000, 50000],
+							help = "number of settings for GetItems and the saves")
+	parser.add_argument('--page-size', type = int, default = 1000, help = "GetItemsPaged page size")
+	parser.add_argument('--devices', type = int, nargs = '+', default = [10, 100, 1000],
+							help = "number of devices for the VRM instance allocation")
+	parser.add_argument('--sample', type = int, default = 10,
+							help = "the last allocations measured per device count")
+	parser.add_argument('--clients', type = int, nargs = '+', default = [1, 4, 8],
+							help = "number of concurrent client processes")
+	args = parser.parse_args()
+
+	modes = {'no-delay': ["--no-delay"], 'default': [], 'journal': ["--journal"]}
+	results = {
+		"localsettings": "v%01x.%02x" % (localsettings.FIRMWARE_VERSION_MAJOR, localsettings.FIRMWARE_VERSION_MINOR),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+		"modes": {},
+	}
+	for mode in args.mode or modes:
+		print("running localsettings in %s mode" % mode, file = sys.stderr)
+		results["modes"][mode] = run(args, modes[mode])
+
+	with open(args.output, 'w') as f:
+		json.dump(results, f, indent = 1)
+	print("results written to %s" % args.output, file = sys.stderr)
+
+if __name__ == "__main__":
+	main()
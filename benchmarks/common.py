@@ -0,0 +1,23 @@
+## Helpers shared by the benchmarks.
+
+import os
+import sys
+
+here = os.path.dirname(__file__)
+sys.path.insert(1, os.path.join(here, '..'))
+sys.path.insert(1, os.path.join(here, '../ext/velib_python'))
+
+import localsettings
+
+## Doesn't export anything.
+class NullExporter:
+	connection = None
+
+	def add(self, obj):
+		pass
+
+	def remove(self, obj):
+		pass
+
+def createRoot(exporter = None):
+	return localsettings.RootObject(exporter or NullExporter(), "/", None, removable = False)
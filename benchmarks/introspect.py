@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+## Latency of Introspect on a group, by number of children.
+#
+# The group gets the given number of children, half of them settings and half
+# groups. Introspect is measured right after a child was added, so nothing can
+# be cached, and while nothing changes.
+
+import argparse
+import time
+import timeit
+
+from common import createRoot
+
+def measure(function, number):
+	return min(timeit.repeat(function, number = number, repeat = 5)) / number * 1e6
+
+def measureChanged(root, group, number):
+	durations = []
+	for i in range(number):
+		root.createSettingObjectAndGroups("%s/Changed%d" % (group._object_path, i))
+		start = time.perf_counter()
+		group.Introspect()
+		durations.append(time.perf_counter() - start)
+	return min(durations) * 1e6
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--children', type = int, nargs = '+', default = [10, 100, 1000, 10000],
+							help = "number of children of the group")
+	parser.add_argument('--number', type = int, default = 100, help = "calls per measurement")
+	args = parser.parse_args()
+
+	print("%8s %14s %14s" % ("children", "changed (us)", "unchanged (us)"))
+	for children in args.children:
+		root = createRoot()
+		path = "/Settings/Benchmark%d" % children
+		for i in range(children // 2):
+			root.createSettingObjectAndGroups("%s/S%d" % (path, i))
+			root.createSettingObjectAndGroups("%s/G%d/S" % (path, i))
+		group = root.getGroup(path)
+		print("%8d %14.0f %14.0f" % (children,
+			measureChanged(root, group, args.number),
+			measure(group.Introspect, args.number)))
+
+if __name__ == "__main__":
+	main()
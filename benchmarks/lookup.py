@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+## Latency of looking up settings and groups by path.
+#
+# A setting is created at every depth, like /Settings/Benchmark/D1/D2/S, in a
+# tree with some other settings and groups at every level. Lookups are done
+# from the root with the full path and from /Settings with the relative path.
+
+import argparse
+import timeit
+
+from common import createRoot
+
+def createTree(maxDepth, width):
+	root = createRoot()
+	for depth in range(1, maxDepth + 1):
+		group = "/Settings/Benchmark" + "".join("/D%d" % i for i in range(1, depth))
+		for i in range(width):
+			root.createSettingObjectAndGroups("%s/S%d" % (group, i))
+			root.createGroups("%s/G%d" % (group, i))
+	return root
+
+def measure(function, path, number):
+	return min(timeit.repeat(lambda: function(path), number = number, repeat = 5)) / number * 1e9
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--depth', type = int, default = 10, help = "deepest group level")
+	parser.add_argument('--width', type = int, default = 20, help = "settings and groups per level")
+	parser.add_argument('--number', type = int, default = 20000, help = "lookups per measurement")
+	args = parser.parse_args()
+
+	root = createTree(args.depth, args.width)
+	settings = root.getGroup("/Settings")
+
+	print("%6s %14s %14s %14s" % ("depth", "setting (ns)", "relative (ns)", "group (ns)"))
+	for depth in range(1, args.depth + 1):
+		group = "/Settings/Benchmark" + "".join("/D%d" % i for i in range(1, depth))
+		setting = group + "/S%d" % (args.width - 1)
+		assert root.getSettingObject(setting) is not None
+		print("%6d %14.0f %14.0f %14.0f" % (depth,
+			measure(root.getSettingObject, setting, args.number),
+			measure(settings.getSettingObject, setting[len("/Settings/"):], args.number),
+			measure(root.getGroup, group, args.number)))
+
+if __name__ == "__main__":
+	main()
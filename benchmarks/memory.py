@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+## Memory used by the settings objects, per setting.
+#
+# The settings are created in groups of 10, like /Settings/Benchmark/G12/S3,
+# with a value, default, min and max. The memory is measured with tracemalloc
+# and includes the groups and the cached xml of the settings.
+#
+# By default the settings are not exported on D-Bus. With --exporter objects
+# or --exporter virtual they are exported on the session bus, as localsettings
+# does by default or with --virtual-tree.
+#
+# The results can be written as JSON with --output, and compared with those of
+# an earlier run, e.g. of another release, with --compare.
+
+import argparse
+import gc
+import json
+import tracemalloc
+
+from common import localsettings, NullExporter, createRoot
+
+def createExporter(kind):
+	if kind == "none":
+		return NullExporter()
+	import dbus
+	from dbus.mainloop.glib import DBusGMainLoop
+	return localsettings.BusExporter(dbus.SessionBus(mainloop = DBusGMainLoop(), private = True), kind == "virtual")
+
+def createSettings(exporter, count):
+	root = createRoot(exporter)
+	for i in range(count):
+		path = "/Settings/Benchmark/G%d/S%d" % (i // 10, i % 10)
+		setting = root.createSettingObjectAndGroups(path)
+		setting.setAttributes(10, "i", 0, 100, False)
+		setting.value = i % 100
+		setting.xmlElement()
+	return root
+
+def measure(kind, count):
+	exporter = createExporter(kind)
+	gc.collect()
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	root = createSettings(exporter, count)
+	gc.collect()
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	# The settings are only released after measuring them.
+	del root
+	return (after - before) / count
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--exporter', choices = ["none", "objects", "virtual"], default = "none",
+							help = "how to export the settings on D-Bus")
+	parser.add_argument('--output', metavar = 'FILE', help = "write the results to this file")
+	parser.add_argument('--compare', metavar = 'FILE', help = "compare with the results of an earlier --output")
+	parser.add_argument('counts', nargs = '*', type = int, default = [1000, 10000, 50000],
+							help = "number of settings")
+	args = parser.parse_args()
+
+	results = {
+		"localsettings": "v%01x.%02x" % (localsettings.FIRMWARE_VERSION_MAJOR, localsettings.FIRMWARE_VERSION_MINOR),
+		"exporter": args.exporter,
+		"bytes_per_setting": {},
+	}
+	baseline = {}
+	if args.compare:
+		with open(args.compare) as f:
+			compare = json.load(f)
+		if compare["exporter"] != args.exporter:
+			parser.error("%s was measured with --exporter %s" % (args.compare, compare["exporter"]))
+		baseline = compare["bytes_per_setting"]
+		print("%10s %18s %18s %8s" % ("settings", "bytes per setting", compare["localsettings"], "change"))
+	else:
+		print("%10s %18s" % ("settings", "bytes per setting"))
+
+	for count in args.counts:
+		size = results["bytes_per_setting"][str(count)] = measure(args.exporter, count)
+		before = baseline.get(str(count))
+		if before:
+			print("%10d %18.0f %18.0f %7.1f%%" % (count, size, before, (size - before) * 100 / before))
+		elif args.compare:
+			print("%10d %18.0f %18s %8s" % (count, size, "-", "-"))
+		else:
+			print("%10d %18.0f" % (count, size))
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent = 1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+## Time needed to migrate settings files of every old version.
+#
+# The synthetic settings files contain the settings the migrations look for,
+# and a number of devices, half of them with a VE.Direct style class, which
+# are renamed while keeping the instances unique. Every version is migrated
+# with the full migration chain, like localsettings does at startup.
+#
+# Some migrations check and create files in /data/conf, so this is meant to be
+# run on a development machine, not on a GX device.
+
+import argparse
+import copy
+import os
+import time
+
+from common import localsettings
+import migrate
+from lxml import etree
+
+def syntheticSettings(version, devices):
+	root = etree.Element("Settings", version = str(version))
+
+	def add(path, value, type = "i", **attributes):
+		node = migrate.get_or_create_node_and_parents(root, path)
+		node.text = str(value)
+		node.set("type", type)
+		for name, attribute in attributes.items():
+			node.set(name, str(attribute))
+
+	add("Services/Mqtt", 1)
+	add("Services/Vrmpubnub", 1)
+	add("Services/FischerPandaAutoStartStop", 1)
+	add("System/RemoteSupport", 1)
+	add("System/RemoteSupportPort", 0)
+	add("System/VncLocal", 0)
+	add("System/VncInternet", 1)
+	add("Vrmlogger/Logmode", 1)
+	add("FischerPanda0/AutoStartEnabled", 0)
+	add("Fronius/InverterIds", "fronius_1,fronius_2", "s")
+	add("DynamicEss/GridImportLimit", 10)
+	add("Relay/Function", 2)
+	add("Relay/Polarity", 1)
+	for n in range(1, 5):
+		add("AnalogInput/Resistive/_%d/Function" % n, 1.0, "f")
+		add("Tank/_%d/FluidType" % n, 1.0, "f", default = 0.0, min = 0.0, max = 10.0)
+		add("Gui/BriefView/Level/_%d" % n, n, "s", default = 0)
+
+	for n in range(devices):
+		device = "Devices/device_%d" % n
+		if n % 2:
+			add(device + "/ClassAndVrmInstance", "com.victronenergy.solarcharger:%d" % n, "s",
+				default = "com.victronenergy.solarcharger:0")
+		elif n % 3:
+			add(device + "/ClassAndVrmInstance", "analog:%d" % n, "s", default = "analog:0")
+			add(device + "/FluidType", 0)
+		else:
+			add(device + "/ClassAndVrmInstance", "battery:%d" % n, "s", default = "battery:0")
+		add(device + "/CustomName", "", "s", default = "")
+
+	return etree.ElementTree(root)
+
+def measure(version, devices, repeat):
+	tree = syntheticSettings(version, devices)
+	best = None
+	for i in range(repeat):
+		copied = copy.deepcopy(tree)
+		start = time.monotonic()
+		migrate.migrate(None, copied, version)
+		elapsed = time.monotonic() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best * 1000
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--repeat', type = int, default = 3, help = "runs per measurement, the best is reported")
+	parser.add_argument('--versions', type = int, nargs = 2, default = [1, int(localsettings.settingsVersion) - 1],
+							metavar = ('FIRST', 'LAST'), help = "settings versions to migrate")
+	parser.add_argument('devices', nargs = '*', type = int, default = [100, 500, 2000],
+							help = "number of devices in the settings files")
+	args = parser.parse_args()
+
+	if os.path.isdir("/data/conf"):
+		parser.error("don't run this on a GX device, the migrations change files in /data/conf")
+
+	print("%8s" % "version" + "".join("%14s" % ("%d dev (ms)" % n) for n in args.devices))
+	for version in range(args.versions[0], args.versions[1] + 1):
+		print("%8d" % version + "".join("%14.1f" % measure(version, n, args.repeat) for n in args.devices))
+
+if __name__ == "__main__":
+	main()
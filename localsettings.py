@@ -33,17 +33,31 @@ import sys
 import signal
 from lxml import etree
 import errno
-import os
+import copy
 import re
+import math
+import os
 from collections import defaultdict
+from bisect import bisect_left, bisect_right, insort
 import migrate
 import logging
+import logging.handlers
+import atexit
 from enum import IntEnum, unique
 import argparse
+import json
+import time
+import hashlib
+import marshal
+import struct
+import zlib
+import threading
+import queue
 from subprocess import check_output, CalledProcessError
 from functools import partial
 import psutil
-from dbus.lowlevel import MethodCallMessage
+from dbus.lowlevel import MethodCallMessage, ErrorMessage
+from _dbus_bindings import DBUS_INTROSPECT_1_0_XML_DOCTYPE_DECL_NODE
 
 from gi.repository import GLib
 
@@ -68,6 +82,9 @@ supportedTypes = {
 DBUS_OK = dbus.types.Int32(0)
 DBUS_ERR = dbus.types.Int32(-1)
 
+## An element of a D-Bus object path, which is also a valid xml tag name.
+pathElementRegex = re.compile(r'[A-Za-z0-9_]+\Z')
+
 ## Settings file version tag, encoding and root-element.
 settingsTag = 'version'
 uniqueIdTag = 'unique-id'
@@ -90,14 +107,87 @@ class AddSettingError(IntEnum):
 	IsGroup = dbus.types.Int32(-8)
 	NotInSettings = dbus.types.Int32(-9)
 
-class SettingObject(dbus.service.Object):
+## Base class of the settings and groups.
+#
+# These are not dbus.service.Objects themselves, the BusExporter makes them
+# available on D-Bus. The D-Bus methods and signals are declared as usual
+# though and are dispatched by the BusExporter.
+#
+# There can be a lot of settings, so the objects are kept small with __slots__.
+class TreeObject(metaclass=dbus.service.InterfaceType):
+	__slots__ = ('_exporter', '_object_path', '_id')
+
+	def __init__(self, exporter, objectPath):
+		self._exporter = exporter
+		self._object_path = objectPath
+		# The same names are used in many groups, like Enabled or ClassAndVrmInstance.
+		self._id = sys.intern(objectPath.rsplit("/", 1)[-1])
+		exporter.add(self)
+
+	## The last part of the path.
+	def id(self):
+		return self._id
+
+	def removeFromBus(self):
+		self._exporter.remove(self)
+
+	@property
+	def connection(self):
+		return self._exporter.connection
+
+	# Where the dbus.service.signal decorator sends the signals to.
+	@property
+	def locations(self):
+		return ((self._exporter.connection, self._object_path),)
+
+	## The names of the child nodes, for the introspection data.
+	def childNames(self):
+		return []
+
+	## The interfaces in the introspection data by class, see interfacesXml.
+	_interfacesXml = {}
+
+	## The introspection data of the interfaces of the class, the same for
+	# all its objects.
+	@classmethod
+	def interfacesXml(cls):
+		data = cls._interfacesXml.get(cls)
+		if data is not None:
+			return data
+		data = ''
+		for name, funcs in cls._dbus_class_table[cls.__module__ + '.' + cls.__name__].items():
+			data += '  <interface name="%s">\n' % name
+			for func in funcs.values():
+				if getattr(func, '_dbus_is_method', False):
+					data += cls._reflect_on_method(func)
+				elif getattr(func, '_dbus_is_signal', False):
+					data += cls._reflect_on_signal(func)
+			data += '  </interface>\n'
+		cls._interfacesXml[cls] = data
+		return data
+
+	def introspectionData(self):
+		return (DBUS_INTROSPECT_1_0_XML_DOCTYPE_DECL_NODE + '<node name="%s">\n' % self._object_path +
+				self.interfacesXml() + ''.join(['  <node name="%s"/>\n' % name for name in self.childNames()]) +
+				'</node>\n')
+
+	## Dbus method Introspect.
+	# Like the introspection of a dbus.service.Object, but with the children
+	# of the settings tree instead of the registered child objects.
+	@dbus.service.method(dbus.INTROSPECTABLE_IFACE, out_signature = 's')
+	def Introspect(self):
+		return self.introspectionData()
+
+class SettingObject(TreeObject):
+	__slots__ = ('group', 'value', 'min', 'max', 'default', 'silent', 'type', '_xml', '_properties')
+
 	## Constructor of SettingObject
 	#
-	# Creates the dbus-object under the given bus-name (dbus-service-name).
-	# @param dbusConnection Return value from e.g. dbus.SessionBus().
+	# Creates the setting and exports it on D-Bus.
+	# @param exporter The BusExporter.
 	# @param objectPath The dbus-object-path (e.g. '/Settings/Logging/LogInterval').
-	def __init__(self, conn, objectPath):
-		dbus.service.Object.__init__(self, conn=conn, object_path=objectPath)
+	def __init__(self, exporter, objectPath):
+		super().__init__(exporter, objectPath)
 		self.group = None
 		self.value = None
 		self.min = None
@@ -105,14 +195,23 @@ class SettingObject(dbus.service.Object):
 		self.default = None
 		self.silent = False
 		self.type = None
+		self._xml = None
+		self._properties = None
 
 	def remove(self):
 		change = {'Value': dbus.Array([], signature=dbus.Signature('i'), variant_level=1), 'Text': ''}
-		self.PropertiesChanged(change)
-		self.remove_from_connection()
-		if self.group:
-			self.group._settings.pop(self.id())
-		self.group.cleanup()
+		self.signalChange(change)
+		self.removeFromBus()
+		localSettings.settingRemoved(self)
+		# A removed setting has no group, see setValueIfAllowed.
+		group = self.group
+		self.group = None
+		if group:
+			group._unindexObject(self)
+			group._settings.pop(self._id)
+			group._removeFromOrder(self._id, True)
+			group._invalidate()
+			group.cleanup()
 
 	def fromXml(self, element):
 		elementType = element.attrib["type"]
@@ -125,22 +224,35 @@ class SettingObject(dbus.service.Object):
 		silent = toBool(e.get("silent"))
 		self.setAttributes(default, elementType, min, max, silent)
 
-	def storeAttribute(self, element, name):
-		value = getattr(self, name)
-		if value is None:
-			return
-		element.set(name, str(value))
+	## The attributes as stored in the xml file.
+	def attributes(self):
+		ret = []
+		for name in ("type", "min", "max", "default", "silent"):
+			value = getattr(self, name)
+			if value is not None:
+				ret.append((name, str(value)))
+		return tuple(ret)
 
 	def toXml(self, element):
-		self.storeAttribute(element, "type")
-		self.storeAttribute(element, "min")
-		self.storeAttribute(element, "max")
-		self.storeAttribute(element, "default")
-		self.storeAttribute(element, "silent")
+		for name, value in self.attributes():
+			element.set(name, value)
 		element.text = str(self.value)
 
-	def id(self):
-		return self._object_path.split("/")[-1]
+	## The setting as a line in the xml file, cached till the setting changes.
+	def xmlElement(self):
+		if self._xml is None:
+			element = etree.Element(tagForXml(self._id))
+			self.toXml(element)
+			self._xml = xmlIndent(self._object_path) + \
+				etree.tostring(element, encoding = settingsEncoding, xml_declaration = False) + b'\n'
+		return self._xml
+
+	## Invalidate the cached xml and properties of the setting and its groups.
+	def _invalidate(self):
+		self._xml = None
+		self._properties = None
+		if self.group:
+			self.group._invalidate()
 
 	def setAttributes(self, default, type, min, max, silent):
 		ret = self.default != default or self.type != type or self.min != min or \
@@ -152,6 +264,9 @@ class SettingObject(dbus.service.Object):
 		self.max = max
 		self.silent = silent
 
+		if ret:
+			self._invalidate()
+
 		return AddSettingError.NoError, ret
 
 	## Dbus method GetValue
@@ -166,54 +281,31 @@ class SettingObject(dbus.service.Object):
 	def GetText(self):
 		return dbus.types.String(self.value)
 
-	def getPid(self, sender):
-		try:
-			# NOTE: in general it is not a good idea to make these kind
-			# of blocking dbus calls. This asks the dbus daemon though,
-			# not a service with is potentially blocking on this service.
-			msg = MethodCallMessage(destination="org.freedesktop.DBus",
-									path="/",
-									interface="org.freedesktop.DBus",
-									method="GetConnectionUnixProcessID",
-									)
-			msg.append(sender, signature="s")
-			reply = self.connection.send_message_with_reply_and_block(msg)
-			args = reply.get_args_list()
-			if (len(args) >= 1):
-				return args[0]
-			return -1
-		except:
-			return -1
-
 	## Dbus method SetValue
 	# Sets the value of a setting. When the type of the setting is a integer or float,
 	# the new value is checked according to minimum and maximum.
 	# @param value The new value for the setting.
 	# @return completion-code When successful a 0 is return, and when not a -1 is returned.
-	@dbus.service.method(InterfaceBusItem, in_signature = 'v', out_signature = 'i', sender_keyword='sender')
-	def SetValue(self, value, sender):
-
-		# The venus-platform api must be used to change the SecurityProfile
-		if self._object_path == "/Settings/System/SecurityProfile":
-			pid = self.getPid(sender)
-			if pid < 0:
-				print("could not find the pid for " + sender)
-				return DBUS_ERR
-
-			p = psutil.Process(pid)
-			cmd = p.cmdline()
-			is_reset = len(cmd) >= 2 and cmd[0] == "/usr/bin/python3" and cmd[-1] == "/opt/victronenergy/venus-button-handler/network-reset"
-			if p.name() != "venus-platform" and not is_reset:
-				print("disallowing Security Profile change from " + str(p.cmdline()))
-				return DBUS_ERR
+	@dbus.service.method(InterfaceBusItem, in_signature = 'v', out_signature = 'i', sender_keyword='sender',
+							async_callbacks=('reply', 'error'))
+	def SetValue(self, value, sender, reply, error):
+		accessPolicy.authorize(self.connection, sender, (self._object_path,),
+								replyWith(reply, error, lambda allowed: self.setValueIfAllowed(value, allowed)))
+
+	## The SetValue once the sender is known, allowed tells whether the sender
+	# may change a path.
+	def setValueIfAllowed(self, value, allowed):
+		# The setting might be removed while the sender was looked up.
+		if self.group is None or not allowed(self._object_path):
+			return DBUS_ERR
 
 		v = convertToType(self.type, value)
 		if v is None:
 			return DBUS_ERR
 
-		if hasattr(self, "min") and self.min is not None and v < self.min:
+		if self.min is not None and v < self.min:
 			return DBUS_ERR
-		if hasattr(self, "max") and self.max is not None and v > self.max:
+		if self.max is not None and v > self.max:
 			return DBUS_ERR
 
 		if v != self.value:
@@ -238,7 +330,10 @@ class SettingObject(dbus.service.Object):
 	def GetSilent(self):
 		return dbus.types.Boolean(self.silent)
 
+	## The properties as returned by GetItems, cached till the setting changes.
 	def getProperties(self):
+		if self._properties is not None:
+			return self._properties
 		ret = dbus.Dictionary(signature = dbus.Signature('sv'), variant_level=0)
 		ret['Value'] = dbus_wrap(self.type, self.value)
 		ret['Text'] = dbus.types.String(self.value)
@@ -248,31 +343,44 @@ class SettingObject(dbus.service.Object):
 			ret['Min'] = dbus_wrap(self.type, self.min)
 		if self.default is not None:
 			ret['Default'] = dbus_wrap(self.type, self.default)
+		self._properties = ret
 		return ret
 
 	## Sets the value and starts the time-out for saving to the settings-xml-file.
 	# @param value The new value for the setting.
-	def _setValue(self, value, printLog=True, sendAttributes=False):
+	def _setValue(self, value, printLog=True, sendAttributes=False, signal=True):
 		global localSettings
 
 		if printLog and not self.silent:
-			logging.info('Setting %s changed. Old: %s, New: %s' % (self._object_path, self.value, value))
+			changeLog.changed(self._object_path, self.value, value)
 
 		self.value = value
-		localSettings.startTimeoutSaveSettings()
+		self._invalidate()
+		localSettings.settingChanged(self)
+		if not signal:
+			return True
 		text = self.GetText()
 		change = {'Value': value, 'Text': text}
 		if sendAttributes:
 			change.update({'Default': self.GetDefault()})
 			if self.type != 's':
 				change.update({'Min': self.GetMin(), 'Max': self.GetMax()})
-		self.PropertiesChanged(change)
+		self.signalChange(change)
 
 		return True
 
+	## Signal a change with PropertiesChanged and the ItemsChanged of the root.
+	def signalChange(self, change):
+		root = self.group._root if self.group else None
+		if root is None or root.propertiesChanged:
+			self.PropertiesChanged(change)
+		if root is not None:
+			root.itemChanged(self, change)
+
 	@dbus.service.signal(InterfaceBusItem, signature = 'a{sv}')
 	def PropertiesChanged(self, changes):
 		logging.debug('signal PropertiesChanged')
+		stats.signalSent('PropertiesChanged')
 
 	## Dbus method GetDefault.
 	# Returns the default value of a setting.
@@ -282,11 +390,16 @@ class SettingObject(dbus.service.Object):
 			return DBUS_ERR
 		return dbus_wrap(self.type, self.default)
 
-	@dbus.service.method(InterfaceBusItem, out_signature = 'i', sender_keyword='sender')
-	def SetDefault(self, sender):
+	@dbus.service.method(InterfaceBusItem, out_signature = 'i', sender_keyword='sender',
+							async_callbacks=('reply', 'error'))
+	def SetDefault(self, sender, reply, error):
+		accessPolicy.authorize(self.connection, sender, (self._object_path,),
+								replyWith(reply, error, self.setDefaultIfAllowed))
+
+	def setDefaultIfAllowed(self, allowed):
 		if self.default is None:
 			return DBUS_ERR
-		self.SetValue(self.default, sender)
+		self.setValueIfAllowed(self.default, allowed)
 		return DBUS_OK
 
 	@dbus.service.method(InterfaceSettings, out_signature = 'vvvi')
@@ -294,31 +407,121 @@ class SettingObject(dbus.service.Object):
 		return (self.GetDefault(), self.GetMin(), self.GetMax(),
 			dbus.types.Int32(self.silent))
 
-class GroupObject(dbus.service.Object):
-	def __init__(self, conn, path, parent, removable = True):
-		dbus.service.Object.__init__(self, conn=conn, object_path=path)
+class GroupObject(TreeObject):
+	__slots__ = ('_parent', '_root', '_children', '_settings', '_removable', '_watchers', '_xml', '_order', '_cache',
+					'_introspection')
+
+	def __init__(self, exporter, path, parent, removable = True):
+		super().__init__(exporter, path)
 		self._parent = parent
+		self._root = parent._root if parent is not None else self
 		self._children = {}
 		self._settings = {}
 		self._removable = removable
-
-	def toXml(self, element):
-		for childId in self._children:
-			subElement = etree.SubElement(element, tagForXml(childId))
-			self._children[childId].toXml(subElement)
-
-		for settingId in self._settings:
-			subElement = etree.SubElement(element, tagForXml(settingId))
-			self._settings[settingId].toXml(subElement)
+		## The unique names of the clients which enabled the ItemsChanged of
+		# the group for its subtree, see EnableItemsChanged. None if there
+		# never were any.
+		self._watchers = None
+		self._xml = None
+		## Results of the D-Bus methods returning all settings, see _cached.
+		self._cache = {}
+		## The children and settings in the order of the xml file, see _orderKey.
+		self._order = []
+		## The introspection data, till the children change.
+		self._introspection = None
+
+	## Children are sorted by their tag in the xml file. A child group
+	# goes before a setting with the same tag, like a stable sort of the
+	# elements as written by toXml used to do.
+	@staticmethod
+	def _orderKey(id, isSetting):
+		return (tagForXml(id), isSetting, id)
+
+	## All children are added and removed through _addToOrder and
+	# _removeFromOrder, which also drop the introspection data.
+	def _addToOrder(self, id, isSetting):
+		insort(self._order, self._orderKey(id, isSetting))
+		self._introspection = None
+
+	def _removeFromOrder(self, id, isSetting):
+		key = self._orderKey(id, isSetting)
+		i = bisect_left(self._order, key)
+		if i < len(self._order) and self._order[i] == key:
+			del self._order[i]
+		self._introspection = None
+
+	## The elements of the children in the xml file, sorted by tag. The
+	# elements are cached by the children, so only the groups in the path of
+	# changed settings need to be serialized again.
+	def xmlContent(self):
+		elements = ((self._settings[id] if isSetting else self._children[id]).xmlElement()
+						for _tag, isSetting, id in self._order)
+		return tuple(element for element in elements if element)
+
+	## The tags and elements of the children, see xmlContent.
+	def xmlChildren(self):
+		elements = ((tag, (self._settings[id] if isSetting else self._children[id]).xmlElement())
+						for tag, isSetting, id in self._order)
+		return tuple((tag, element) for tag, element in elements if element)
+
+	def xmlElement(self):
+		if self._xml is None:
+			tag = tagForXml(self._id)
+			# Fails for invalid tags, like writing the element would.
+			etree.Element(tag)
+			indent = xmlIndent(self._object_path)
+			content = self.xmlContent()
+			tag = tag.encode(settingsEncoding)
+			if content:
+				self._xml = indent + b'<' + tag + b'>\n' + b''.join(content) + indent + b'</' + tag + b'>\n'
+			elif self._removable:
+				# An empty group is only kept for a watcher, see
+				# EnableItemsChanged. It is left out, like journal replay
+				# drops it, otherwise it would stay after a restart.
+				self._xml = b''
+			else:
+				self._xml = indent + b'<' + tag + b'/>\n'
+		return self._xml
+
+	## Invalidate the cached xml and results of this group and all its parents.
+	def _invalidate(self):
+		group = self
+		while group is not None:
+			group._xml = None
+			if group._cache:
+				group._cache = {}
+			group = group._parent
+
+	## Returns the cached result of function, it is only called again after
+	# something in the group changed.
+	def _cached(self, name, function):
+		ret = self._cache.get(name)
+		if ret is None:
+			ret = self._cache[name] = function()
+		return ret
 
 	def cleanup(self):
-		if not self._removable:
+		if not self._removable or self._watchers:
 			return
 		if not self._children and not self._settings:
 			if self._parent:
-				self._parent._children.pop(self._object_path.split("/")[-1])
+				id = self._id
+				self._unindexObject(self)
+				self._parent._children.pop(id)
+				self._parent._removeFromOrder(id, False)
+				self._parent._invalidate()
+				localSettings.groupRemoved(self)
 				self._parent.cleanup()
-			self.remove_from_connection()
+			self.removeFromBus()
+
+	def childNames(self):
+		return [id for _tag, _isSetting, id in self._order]
+
+	## Groups can have many children, so their introspection data is cached.
+	def introspectionData(self):
+		if self._introspection is None:
+			self._introspection = super().introspectionData()
+		return self._introspection
 
 	def _path(self):
 		return "" if self._object_path == "/" else self._object_path
@@ -340,49 +543,77 @@ class GroupObject(dbus.service.Object):
 
 	# just to make it easy to overload
 	def _newSubGroup(self, path):
-		return GroupObject(self.connection, path, self)
+		return GroupObject(self._exporter, path, self)
 
 	def _newSettingObject(self, tag):
-		return SettingObject(self.connection, self._object_path + "/" + tag)
+		return SettingObject(self._exporter, self._object_path + "/" + tag)
 
-	def createGroupsFromList(self, list):
-		if not list:
-			return self
-		subgroup = list.pop(0)
-		if subgroup not in self._children:
-			path = self._path() + "/" + subgroup
-			self._children[subgroup] = self._newSubGroup(path)
-		if len(list):
-			return self._children[subgroup].createGroupsFromList(list)
-		else:
-			return self._children[subgroup]
+	## Whether the elements of a path can be used as ids in the tree.
+	@staticmethod
+	def _validPathElements(list):
+		return all(pathElementRegex.match(x) for x in list)
 
-	def getGroup(self, path):
-		list = self._split_path(path)
-		if not list:
+	## Returns the group, or None if a setting is in the way or the path is
+	# invalid.
+	def createGroupsFromList(self, list):
+		if not self._validPathElements(list):
 			return None
-		return self.getGroupFromList(list)
+		group = self
+		for subgroup in list:
+			child = group._children.get(subgroup)
+			if child is None:
+				if subgroup in group._settings:
+					return None
+				child = group._newSubGroup(group._path() + "/" + subgroup)
+				group._children[subgroup] = child
+				group._addToOrder(subgroup, False)
+				group._invalidate()
+				group._indexObject(child)
+			group = child
+		return group
+
+	## All settings and groups in the tree are indexed by their full path
+	# in the root, so they can be looked up without walking the tree.
+	def _indexObject(self, obj):
+		self._root._objects[obj._object_path] = obj
+
+	def _unindexObject(self, obj):
+		objects = self._root._objects
+		if objects.get(obj._object_path) is obj:
+			del objects[obj._object_path]
+
+	## The full object path of a path relative to this group.
+	def _fullPath(self, path):
+		if path.startswith("/"):
+			path = path[1:]
+		return self._path() + "/" + path
 
-	def getGroupFromList(self, list):
-		if not list:
-			return self
-		subgroup = list.pop(0)
-		if subgroup not in self._children:
-			return None
-		return self._children[subgroup].getGroupFromList(list)
+	def getGroup(self, path):
+		group = self._root._objects.get(self._fullPath(path))
+		return group if isinstance(group, GroupObject) else None
 
 	def addSettingObject(self, setting):
 		id = setting.id()
 		if id in self._children:
 			return False
+		if id in self._settings:
+			self._removeFromOrder(id, True)
 		self._settings[id] = setting
+		self._addToOrder(id, True)
 		setting.group = self
+		self._invalidate()
+		self._indexObject(setting)
 		return True
 
 	def addGroup(self, id, group):
 		if self._settings:
 			return False
+		if id in self._children:
+			self._removeFromOrder(id, False)
 		self._children[id] = group
+		self._addToOrder(id, False)
+		self._invalidate()
+		self._indexObject(group)
 
 	def createGroupsForObjectPath(self, path):
 		list = self._split_path(path)
@@ -392,24 +623,20 @@ class GroupObject(dbus.service.Object):
 		return self.createGroupsFromList(list)
 
 	def createSettingObjectAndGroups(self, path):
+		id = path.split("/")[-1]
+		if not self._validPathElements([id]):
+			return None
 		group = self.createGroupsForObjectPath(path)
 		if not group:
 			return None
-		setting = group._newSettingObject(path.split("/")[-1])
+		setting = group._newSettingObject(id)
 		if not group.addSettingObject(setting):
 			return None
 		return setting
 
 	def getSettingObject(self, path):
-		list = self._split_path(path)
-		if not list:
-			return None
-		name = list[-1]
-		del(list[-1])
-		group = self.getGroupFromList(list)
-		if not group:
-			return None
-		return group._settings.get(name)
+		setting = self._root._objects.get(self._fullPath(path))
+		return setting if isinstance(setting, SettingObject) else None
 
 	def addSettingObjectsToList(self, list):
 		list.extend(self._settings.values())
@@ -421,6 +648,33 @@ class GroupObject(dbus.service.Object):
 		self.addSettingObjectsToList(list)
 		return list
 
+	## Yields the settings in the subtree in the order of the settings file.
+	# When after is given, as the parts of a path relative to the group, only
+	# the settings following that path are yielded, whether it still exists or
+	# not.
+	def iterSettingObjects(self, after = ()):
+		order = self._order
+		start = 0
+		if len(after) > 1:
+			key = self._orderKey(after[0], False)
+			start = bisect_left(order, key)
+			if start < len(order) and order[start] == key:
+				yield from self._children[after[0]].iterSettingObjects(after[1:])
+				start += 1
+		elif after:
+			start = bisect_right(order, self._orderKey(after[0], True))
+
+		for n in range(start, len(order)):
+			_tag, isSetting, id = order[n]
+			if isSetting:
+				yield self._settings[id]
+			else:
+				yield from self._children[id].iterSettingObjects()
+
+	## Returns the setting or group for the path, if any.
+	def getObject(self, path):
+		return self._root._objects.get(self._fullPath(path))
+
 	## Dbus method AddSetting.
 	# Add a new setting by the given parameters. The object-path must be a group.
 	# Example 1: dbus /Settings AddSetting Groupname Settingname 100 i 0 100
@@ -455,33 +709,17 @@ class GroupObject(dbus.service.Object):
 		return self.addSetting(relativePath, defaultValue, itemType, minimum, maximum, silent)
 
 	def addSetting(self, relativePath, defaultValue, itemType, minimum, maximum, silent):
+		# The type is stored in the startup snapshot, which can't contain dbus types.
+		itemType = str(itemType)
+
 		# A prefixing underscore is an escape char: don't allow it in a normal path
 		if "/_" in relativePath:
 			return AddSettingError.UnderscorePrefix, None
 
-		if itemType not in supportedTypes:
-			return AddSettingError.UnknownType, None
-
-		value = convertToType(itemType, defaultValue)
-		if value is None:
-			return AddSettingError.InvalidDefault, None
-		defaultValue = value
-		min = convertToType(itemType, minimum)
-		max = convertToType(itemType, maximum)
-
-		if not isinstance(value, str):
-			if min == 0 and max == 0:
-				min = None
-				max = None
-
-			if min is not None and value < min:
-				return AddSettingError.DefaultOutOfRange, None
-
-			if max is not None and value > max:
-				return AddSettingError.DefaultOutOfRange, None
-		else:
-			min = None
-			max = None
+		error, defaultValue, min, max = settingAttributes(itemType, defaultValue, minimum, maximum)
+		if error != AddSettingError.NoError:
+			return error, None
+		value = defaultValue
 
 		if self._path() == "" and not relativePath.startswith("/Settings/"):
 			return AddSettingError.NotInSettings, None
@@ -495,6 +733,8 @@ class GroupObject(dbus.service.Object):
 				return AddSettingError.IsGroup, None
 
 			settingObject = self.createSettingObjectAndGroups(relativePath)
+			if not settingObject:
+				return AddSettingError.InvalidPath, None
 			settingObject.setAttributes(defaultValue, itemType, min, max, silent)
 		else:
 			# Existing setting
@@ -512,11 +752,46 @@ class GroupObject(dbus.service.Object):
 			settingObject.remove()
 			return AddSettingError.InvalidDefault, None
 
-		logging.info('Added new setting %s. default:%s, type:%s, min:%s, max: %s, silent: %s' % \
-						 (self._path() + "/" + relativePath, defaultValue, itemType, minimum, maximum, silent))
+		logging.info('Added new setting %s/%s. default:%s, type:%s, min:%s, max: %s, silent: %s',
+						 self._path(), relativePath, defaultValue, itemType, minimum, maximum, silent)
 
 		return AddSettingError.NoError, settingObject
 
+	## Add settings like addSetting, for the definitions by path as loaded by
+	# loadSettingsDir. The definitions of a path are added in order, like
+	# separate addSetting calls. Nothing is signalled or logged per setting,
+	# invalid definitions are skipped. Returns the number of added or changed
+	# settings.
+	def addDefaults(self, defaults):
+		changed = 0
+		for relativePath, definitions in defaults.items():
+			for definition in definitions:
+				if self._addDefault(relativePath, *definition):
+					changed += 1
+		return changed
+
+	def _addDefault(self, relativePath, defaultValue, itemType, min, max, silent):
+		settingObject = self.getSettingObject(relativePath)
+		if settingObject is None:
+			if "/_" in relativePath or self.getGroup(relativePath):
+				return False
+			settingObject = self.createSettingObjectAndGroups(relativePath)
+			if not settingObject:
+				return False
+			settingObject.setAttributes(defaultValue, itemType, min, max, silent)
+			if not settingObject._setValue(defaultValue, printLog=False, signal=False):
+				settingObject.remove()
+				return False
+			return True
+
+		if settingObject.type != itemType:
+			return False
+		_error, attributesChanged = settingObject.setAttributes(defaultValue, itemType, min, max, silent)
+		if not attributesChanged:
+			return False
+		settingObject._setValue(settingObject.value, printLog=False, signal=False)
+		return True
+
 	@dbus.service.method(InterfaceSettings, in_signature = 'aa{sv}', out_signature = 'aa{sv}')
 	def AddSettings(self, definition):
 		ret = []
@@ -572,51 +847,249 @@ class GroupObject(dbus.service.Object):
 
 		return ret
 
+	## Dbus method GetValues
+	# Returns the values of the given settings, relative to this group.
+	# Paths which aren't a setting are left out.
+	@dbus.service.method(InterfaceSettings, in_signature = 'as', out_signature = 'a{sv}')
+	def GetValues(self, paths):
+		ret = dbus.Dictionary(signature = dbus.Signature('sv'))
+		for settingPath in paths:
+			settingObject = self.getSettingObject(settingPath)
+			if settingObject:
+				ret[settingPath] = settingObject.GetValue()
+		return ret
+
+	## Dbus method SetValues
+	# Sets the values of the given settings, relative to this group, like
+	# SetValue does. The changes are saved together.
+	# @return the SetValue completion-code per path, -1 for unknown paths.
+	@dbus.service.method(InterfaceSettings, in_signature = 'a{sv}', out_signature = 'a{si}', sender_keyword='sender',
+							async_callbacks=('reply', 'error'))
+	def SetValues(self, values, sender, reply, error):
+		accessPolicy.authorize(self.connection, sender, [self._fullPath(settingPath) for settingPath in values.keys()],
+								replyWith(reply, error, lambda allowed: self.setValuesIfAllowed(values, allowed)))
+
+	def setValuesIfAllowed(self, values, allowed):
+		ret = dbus.Dictionary(signature = dbus.Signature('si'))
+		for settingPath, value in values.items():
+			settingObject = self.getSettingObject(settingPath)
+			ret[settingPath] = settingObject.setValueIfAllowed(value, allowed) if settingObject else DBUS_ERR
+		return ret
+
 	def forAllSettings(self, function, type = 'v'):
 		prefixLength = len(self._path() + '/')
 		ret = dbus.Dictionary(signature = dbus.Signature('s' + type), variant_level=1)
-		for setting in self.getSettingObjects():
+		for setting in self.iterSettingObjects():
 			relPath = setting._object_path[prefixLength:]
 			value = function(setting)
 			if value is not None:
 				ret[relPath] = value
 		return ret
 
+	## Dbus method EnableItemsChanged
+	# When enabled, the changes of the settings in the subtree of the group are
+	# sent with an ItemsChanged of the group as well, collected like the
+	# ItemsChanged of the root. It is enabled per client, till the last client
+	# which enabled it disables it or leaves the bus. A watched group is kept
+	# when its last setting is removed, so the watch stays while a client
+	# removes and adds settings.
+	@dbus.service.method(InterfaceSettings, in_signature = 'b', out_signature = 'i', sender_keyword = 'sender')
+	def EnableItemsChanged(self, enabled, sender):
+		if enabled:
+			if self._watchers is None:
+				self._watchers = set()
+			self._watchers.add(sender)
+			self._root.watchAdded(self.connection, sender, self)
+		elif self._watchers and sender in self._watchers:
+			self._root.watchRemoved(sender, self)
+			self.unwatch(sender)
+		return DBUS_OK
+
+	def unwatch(self, sender):
+		self._watchers.discard(sender)
+		if not self._watchers:
+			self.cleanup()
+
+	@dbus.service.signal(InterfaceBusItem, signature = 'a{sa{sv}}')
+	def ItemsChanged(self, changes):
+		logging.debug('signal ItemsChanged')
+		stats.signalSent('ItemsChanged')
+
+	## Dbus method GetItems
+	# Returns the properties of all settings in the subtree, by path.
+	@dbus.service.method(InterfaceBusItem, out_signature = 'a{sa{sv}}')
+	def GetItems(self):
+		return self._cached('GetItems', lambda: dbus.Dictionary({
+			setting._object_path: setting.getProperties()
+			for setting in self.iterSettingObjects()
+		}, signature = dbus.Signature('sa{sv}'), variant_level=0))
+
+	## Dbus method GetItemsPaged
+	# Like GetItems, but returns at most limit settings, 0 for no limit,
+	# following the cursor, and the cursor for the next page. Start with an
+	# empty cursor, the returned cursor is empty when there are no more
+	# settings. Settings added or removed between the calls don't disturb the
+	# paging.
+	@dbus.service.method(InterfaceBusItem, in_signature = 'su', out_signature = 'a{sa{sv}}s')
+	def GetItemsPaged(self, cursor, limit):
+		after = ()
+		if cursor:
+			prefix = self._path() + '/'
+			if not cursor.startswith(prefix):
+				raise ValueError('cursor %s is not in %s' % (cursor, self._object_path))
+			after = cursor[len(prefix):].split('/')
+
+		items = dbus.Dictionary(signature = dbus.Signature('sa{sv}'), variant_level=0)
+		last = None
+		for setting in self.iterSettingObjects(after):
+			# Only continue with a next page when there is more.
+			if limit and len(items) == limit:
+				return (items, last)
+			last = setting._object_path
+			items[last] = setting.getProperties()
+		return (items, '')
+
 	@dbus.service.method(InterfaceBusItem, out_signature = 'v')
 	def GetValue(self):
-		return self.forAllSettings(lambda x: x.GetValue())
+		return self._cached('GetValue', lambda: self.forAllSettings(lambda x: x.getProperties()['Value']))
 
 	@dbus.service.method(InterfaceBusItem, out_signature = 'v')
 	def GetText(self):
-		return self.forAllSettings(lambda x: x.GetText(), 's')
+		return self._cached('GetText', lambda: self.forAllSettings(lambda x: x.getProperties()['Text'], 's'))
+
+	@dbus.service.method(InterfaceBusItem, out_signature = 'i', sender_keyword='sender',
+							async_callbacks=('reply', 'error'))
+	def SetDefault(self, sender, reply, error):
+		settings = self.getSettingObjects()
+		accessPolicy.authorize(self.connection, sender, [x._object_path for x in settings],
+								replyWith(reply, error, lambda allowed: self.setDefaultsIfAllowed(settings, allowed)))
 
-	@dbus.service.method(InterfaceBusItem, out_signature = 'i')
-	def SetDefault(self):
-		self.forAllSettings(lambda x: x.SetDefault())
+	def setDefaultsIfAllowed(self, settings, allowed):
+		for setting in settings:
+			setting.setDefaultIfAllowed(allowed)
 		return DBUS_OK
 
 class RootObject(GroupObject):
-	def __init__(self, conn, path, parent, removable = True):
-		super(RootObject, self).__init__(conn, path, parent, removable)
+	__slots__ = ('_objects', '_changedItems', '_watchedChanges', '_watches', '_itemsChangedEventId',
+					'itemsChangedWindow', 'propertiesChanged')
+
+	def __init__(self, exporter, path, parent, removable = True):
+		## The settings and groups by path, see _indexObject.
+		self._objects = {}
+		## The changes which aren't sent with ItemsChanged yet, by path.
+		self._changedItems = {}
+		## The changes for the ItemsChanged of the watched groups, by group.
+		self._watchedChanges = {}
+		## The groups watched by a client, by unique name.
+		self._watches = {}
+		clientTracker.addListener(self._clientLeft)
+		self._itemsChangedEventId = None
+		## Milliseconds to collect changes for a single ItemsChanged. With 0
+		# the changes are sent once the mainloop is idle.
+		self.itemsChangedWindow = 0
+		## Whether the settings also send their own PropertiesChanged.
+		self.propertiesChanged = True
+		super(RootObject, self).__init__(exporter, path, parent, removable)
+
+	## Collect the change of a setting, see sendItemsChanged.
+	def itemChanged(self, setting, change):
+		self._changedItems.setdefault(setting._object_path, {}).update(change)
+		group = setting.group
+		while group is not self:
+			if group._watchers:
+				self._watchedChanges.setdefault(group, {}).setdefault(setting._object_path, {}).update(change)
+			group = group._parent
+		if self._itemsChangedEventId is not None:
+			return
+		if self.itemsChangedWindow:
+			self._itemsChangedEventId = GLib.timeout_add(self.itemsChangedWindow, self._itemsChangedTimeout)
+		else:
+			self._itemsChangedEventId = GLib.idle_add(self._itemsChangedTimeout)
+
+	def _itemsChangedTimeout(self):
+		self._itemsChangedEventId = None
+		self.sendItemsChanged()
+		return False
+
+	## Send all collected changes in a single ItemsChanged signal.
+	def sendItemsChanged(self):
+		if self._itemsChangedEventId is not None:
+			GLib.source_remove(self._itemsChangedEventId)
+			self._itemsChangedEventId = None
+		if not self._changedItems:
+			return
+		changes = self._changedItems
+		self._changedItems = {}
+		self.ItemsChanged(changes)
 
-	@dbus.service.method(InterfaceBusItem, out_signature = 'a{sa{sv}}')
-	def GetItems(self):
-		return dbus.Dictionary({
-			setting._object_path: setting.getProperties()
-			for setting in self.getSettingObjects()
-		}, signature = dbus.Signature('sa{sv}'), variant_level=0)
+		watchedChanges = self._watchedChanges
+		self._watchedChanges = {}
+		for group, changes in watchedChanges.items():
+			group.ItemsChanged(changes)
+
+	## The root always sends ItemsChanged.
+	def EnableItemsChanged(self, enabled, sender):
+		return DBUS_OK
+
+	def watchAdded(self, connection, sender, group):
+		clientTracker.watch(connection)
+		self._watches.setdefault(sender, set()).add(group)
+
+	def watchRemoved(self, sender, group):
+		groups = self._watches.get(sender)
+		if groups is None:
+			return
+		groups.discard(group)
+		if not groups:
+			del self._watches[sender]
+
+	## The groups watched by a client leaving the bus are not watched by it
+	# anymore.
+	def _clientLeft(self, name):
+		for group in self._watches.pop(name, ()):
+			group.unwatch(name)
+
+	## Returns how long the phases of the startup took, in milliseconds.
+	@dbus.service.method(InterfaceBusItem, out_signature = 'a{sd}')
+	def GetStartupProfile(self):
+		return localSettings.startupProfile.milliseconds()
+
+	## Save the pending changes now, replies when they are on disk. The
+	# mainloop doesn't wait for that, so other calls are handled meanwhile.
+	@dbus.service.method(InterfaceBusItem, out_signature = 'i', async_callbacks=('reply', 'error'))
+	def Flush(self, reply, error):
+		localSettings.flush(lambda result: reply(DBUS_OK))
+
+	## Returns the statistics since the last reset, see Stats.
+	@dbus.service.method(InterfaceBusItem, in_signature = 'b', out_signature = 'a{sv}')
+	def GetStats(self, reset):
+		ret = stats.toDbus()
+		if reset:
+			stats.reset()
+		return ret
 
 # Special settings with contains class + instance. It is special since it
 # disallows duplicate values and will be set to the next free one instead
 # when attempting to set an already taken combination.
 class ClassAndVrmInstance(SettingObject):
-	def _setValue(self, value, printLog=True, sendAttributes=False):
+	__slots__ = ()
+
+	def _setValue(self, value, printLog=True, sendAttributes=False, signal=True):
 		valid, devClass, instance = parseClassInstanceString(value)
 		if not valid:
 			return False
 
-		value = self.group._parent.assureFreeInstance(devClass, instance, self)
-		return SettingObject._setValue(self, value, printLog, sendAttributes)
+		devices = self.group._parent
+		value = devices.assureFreeInstance(devClass, instance, self)
+		devices.removeFromInstanceIndex(self)
+		ret = SettingObject._setValue(self, value, printLog, sendAttributes, signal)
+		devices.addToInstanceIndex(self)
+		return ret
+
+	def remove(self):
+		if self.group:
+			self.group._parent.removeFromInstanceIndex(self)
+		super().remove()
 
 	def setAttributes(self, default, type, min, max, silent):
 		if default is not None:
@@ -626,16 +1099,28 @@ class ClassAndVrmInstance(SettingObject):
 
 		return super().setAttributes(default, type, min, max, silent)
 
-	def SetDefault(self):
+	def setDefaultIfAllowed(self, allowed):
 		return DBUS_ERR
 
 ## Unique VRM instances
 # Just a normal group, except for ClassAndInstance which is a special setting
 class DeviceGroup(GroupObject):
+	__slots__ = ()
+
 	def _newSettingObject(self, tag):
 		if tag == "ClassAndVrmInstance":
-			return ClassAndVrmInstance(self.connection, self._object_path + "/" + tag)
-		return SettingObject(self.connection, self._object_path + "/" + tag)
+			return ClassAndVrmInstance(self._exporter, self._object_path + "/" + tag)
+		return SettingObject(self._exporter, self._object_path + "/" + tag)
+
+	def addSettingObject(self, setting):
+		old = self._settings.get(setting.id())
+		if not super().addSettingObject(setting):
+			return False
+		if isinstance(old, ClassAndVrmInstance):
+			self._parent.removeFromInstanceIndex(old)
+		if isinstance(setting, ClassAndVrmInstance):
+			self._parent.addToInstanceIndex(setting)
+		return True
 
 # Assure unique instances per class. The value of ClassAndVrmInstance is e.g.
 # battery:1 / battery:2 etc. The instances are stored under per device unique
@@ -646,23 +1131,136 @@ class DeviceGroup(GroupObject):
 #
 # When adding or attempting to change the ClassAndVrmInstance which is already
 # taken, it will be set to the next free one.
+#
+# The taken instances are indexed per class, so finding a free instance doesn't
+# require checking all the devices.
 class DevicesGroup(GroupObject):
+	__slots__ = ('_instances',)
+
+	def __init__(self, exporter, path, parent, removable = True):
+		super().__init__(exporter, path, parent, removable)
+		## The ClassAndVrmInstance settings per class and instance. Normally
+		# there is one setting per instance, but a settings file can contain
+		# duplicates.
+		self._instances = defaultdict(dict)
+
 	def _newSubGroup(self, path):
-		return DeviceGroup(self.connection, path, self)
+		return DeviceGroup(self._exporter, path, self)
+
+	def addToInstanceIndex(self, settingObject):
+		valid, devClass, instance = parseClassInstanceString(settingObject.value)
+		if valid:
+			self._instances[devClass].setdefault(instance, []).append(settingObject)
+
+	def removeFromInstanceIndex(self, settingObject):
+		valid, devClass, instance = parseClassInstanceString(settingObject.value)
+		if not valid:
+			return
+		instances = self._instances.get(devClass, {})
+		taken = instances.get(instance, [])
+		if settingObject in taken:
+			taken.remove(settingObject)
+			if not taken:
+				del instances[instance]
 
 	# Make sure classInstanceStr is updated to a free one.
 	# returns False if the string cannot be parsed.
 	def assureFreeInstance(self, devClass, instance, settingObject):
-		taken = list(self.forAllSettings(lambda x: x.GetValue() if x is not settingObject and \
-									x.id() == "ClassAndVrmInstance" and \
-									x.GetValue().startswith(devClass + ":") else None).values())
+		instances = self._instances.get(devClass, {})
 
 		while True:
-			classInstanceStr = devClass + ":" + str(instance)
-			if classInstanceStr not in taken:
-				return classInstanceStr
+			taken = instances.get(instance)
+			if not taken or taken == [settingObject]:
+				return devClass + ":" + str(instance)
 			instance += 1
 
+	## Dbus method LookupVrmInstance.
+	# Returns the unique id and the object path of the device which has the
+	# given class and instance, or two empty strings if there is none.
+	@dbus.service.method(InterfaceSettings, in_signature = 'si', out_signature = 'ss')
+	def LookupVrmInstance(self, devClass, instance):
+		taken = self._instances.get(devClass, {}).get(instance)
+		if not taken:
+			return ("", "")
+		device = taken[0].group
+		return (device.id(), device._object_path)
+
+## Handle a method call for a settings object. The dispatching of a
+# dbus.service.Object only looks at the class of the object to find the method,
+# so it is used as is for the settings objects.
+def dispatchMethodCall(obj, connection, message):
+	start = time.monotonic()
+	dbus.service.Object._message_cb(obj, connection, message)
+	stats.methodCalled(message, time.monotonic() - start)
+
+## A single D-Bus object for the whole settings tree, method calls are
+# dispatched to the settings object with the path of the call.
+class FallbackExport(dbus.service.FallbackObject):
+	def __init__(self, connection, root):
+		self._root = root
+		dbus.service.FallbackObject.__init__(self, connection, root._object_path)
+
+	def exports(self):
+		return self._root
+
+	def _message_cb(self, connection, message):
+		if not isinstance(message, MethodCallMessage):
+			return
+
+		path = message.get_path()
+		obj = self._root if path == self._root._object_path else self._root.getObject(path)
+		if obj is None:
+			if not message.get_no_reply():
+				connection.send_message(ErrorMessage(message, 'org.freedesktop.DBus.Error.UnknownObject',
+														"No such object path '%s'" % path))
+			return
+
+		dispatchMethodCall(obj, connection, message)
+
+## Makes the settings objects available on D-Bus.
+#
+# By default the path of every setting and group is registered in libdbus. All
+# of them share a single handler, which looks up the settings object by path,
+# so there is no D-Bus object per setting. With a virtual tree, a single
+# fallback object at / handles the method calls for all paths instead. That
+# also saves the object path registration in libdbus per setting.
+class BusExporter:
+	def __init__(self, connection, virtualTree = False):
+		self.connection = connection
+		self.virtualTree = virtualTree
+		## The settings objects by path, or the FallbackExport at /.
+		self._exported = {}
+		## Shared by all paths, instead of a bound method per path.
+		self._messageCallback = self._message_cb
+
+	def add(self, obj):
+		if self.virtualTree:
+			if obj._object_path == "/":
+				self._exported["/"] = FallbackExport(self.connection, obj)
+			return
+		self.connection._register_object_path(obj._object_path, self._messageCallback)
+		self._exported[obj._object_path] = obj
+
+	def remove(self, obj):
+		if self.virtualTree:
+			exported = self._exported.get(obj._object_path)
+			if exported is not None and exported.exports() is obj:
+				del self._exported[obj._object_path]
+				exported.remove_from_connection()
+			return
+		if self._exported.get(obj._object_path) is not obj:
+			return
+		del self._exported[obj._object_path]
+		try:
+			self.connection._unregister_object_path(obj._object_path)
+		except LookupError:
+			pass
+
+	def _message_cb(self, connection, message):
+		obj = self._exported.get(message.get_path())
+		if obj is not None:
+			dispatchMethodCall(obj, connection, message)
+
 # Helpers
 def parseClassInstanceString(value):
 	if not isinstance(value, (dbus.String, str)):
@@ -702,9 +1300,10 @@ def dbus_wrap(typ, value):
 
 def parseXmlFile(file, items):
 	parser = etree.XMLParser(remove_blank_text=True)
-	tree = etree.parse(file, parser)
-	root = tree.getroot()
-	parseXmlEntry(root, items)
+	parseXmlTree(etree.parse(file, parser), items)
+
+def parseXmlTree(tree, items):
+	parseXmlEntry(tree.getroot(), items)
 
 def tagForXml(path):
 	if len(path) == 0:
@@ -733,13 +1332,452 @@ def parseXmlEntry(element, group):
 			for child in element:
 				parseXmlEntry(child, subgroup)
 
-def writeToXmlFile(localSettings, settingsGroup, serial):
-	root = etree.Element("Settings")
+## Indentation of an element in the xml file, as pretty printed by lxml.
+def xmlIndent(objectPath):
+	return b'  ' * (objectPath.count("/") - 1)
+
+## The data of an element of a child of /Settings, as in the settings file. It
+# is indented like xmlIndent, so it is identical to GroupObject.xmlElement,
+# which makes the shards written by LocalSettings.save and by writeToXml the
+# same.
+def xmlChildData(element):
+	wrapper = etree.Element(settingsRootName)
+	child = copy.deepcopy(element)
+	child.tail = None
+	wrapper.append(child)
+	data = etree.tostring(wrapper, encoding = settingsEncoding, pretty_print = True)
+	return data[data.index(b'\n') + 1:data.rindex(b'</')]
+
+## Write the settings file from the elements of the children of /Settings.
+# The output is identical to writing the sorted tree with lxml.
+def writeToXmlFile(localSettings, content, serial):
+	root = etree.Element(settingsRootName)
 	root.set(settingsTag, settingsVersion)
 	root.set(uniqueIdTag, serial)
-	tree = etree.ElementTree(root)
-	settingsGroup.toXml(root)
-	localSettings.save(tree)
+	empty = etree.tostring(root, encoding = settingsEncoding, xml_declaration = True)
+	if content:
+		data = [empty[:-2] + b'>\n'] + list(content) + [b'</' + settingsRootName.encode(settingsEncoding) + b'>\n']
+	else:
+		data = [empty + b'\n']
+	return localSettings.writeFile(b''.join(data))
+
+## Journal record for a changed setting, None means the setting was removed.
+# The attributes are obtained from toXml, so replaying the record results
+# in exactly the same element as a full save would have written.
+def journalRecord(path, setting):
+	if setting is None:
+		return {'path': path, 'removed': True}
+	element = etree.Element(tagForXml(setting.id()))
+	setting.toXml(element)
+	return {'path': path, 'text': element.text, 'attrib': dict(element.attrib)}
+
+def fileStamp(name):
+	st = os.stat(name)
+	return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+## Apply a journal record to the (not yet parsed) settings tree.
+def applyJournalRecord(root, record):
+	ids = record['path'].split('/')
+	if len(ids) < 3 or ids[0] != '' or ids[1] != settingsRootName:
+		return
+	tags = [tagForXml(id) for id in ids[2:]]
+
+	if record.get('removed'):
+		element = root
+		for tag in tags:
+			element = element.find(tag)
+			if element is None:
+				return
+		# Remove the setting and the groups which became empty, like
+		# GroupObject.cleanup does, except for the fixed Devices group.
+		parent = element.getparent()
+		parent.remove(element)
+		while parent is not root and len(parent) == 0 and \
+				not (parent.getparent() is root and parent.tag == 'Devices'):
+			element = parent
+			parent = element.getparent()
+			parent.remove(element)
+		return
+
+	element = migrate.get_or_create_node_and_parents(root, '/'.join(tags))
+	element.attrib.clear()
+	for name, value in record['attrib'].items():
+		element.set(name, value)
+	element.text = record['text']
+
+## Write-ahead journal for the settings.
+#
+# Instead of rewriting the complete settings file for every change, the
+# changed settings are appended to the journal. The first line of the journal
+# identifies the settings file it belongs to, so a journal which was left
+# behind after the settings file was compacted is not replayed. The journal
+# is replayed and compacted into the settings file at startup.
+class SettingsJournal:
+	def __init__(self, name, settingsFile):
+		self.name = name
+		self.settingsFile = settingsFile
+		self.size = path.getsize(name) if path.isfile(name) else 0
+
+	def exists(self):
+		return self.size > 0
+
+	def append(self, records):
+		lines = []
+		if not self.exists():
+			lines.append(json.dumps({'base': fileStamp(self.settingsFile)}))
+		lines.extend(json.dumps(record) for record in records)
+		data = ('\n'.join(lines) + '\n').encode(settingsEncoding)
+
+		created = not path.isfile(self.name)
+		with open(self.name, 'ab') as fp:
+			fp.write(data)
+			fp.flush()
+			os.fsync(fp.fileno())
+		if created:
+			fsyncDir(self.name)
+		self.size += len(data)
+		return len(data)
+
+	## Apply the journal to the settings tree, returns the number of records.
+	def replay(self, tree):
+		if not self.exists():
+			return 0
+
+		count = 0
+		with open(self.name, 'rb') as fp:
+			lines = fp.read().decode(settingsEncoding).split('\n')
+
+		try:
+			header = json.loads(lines[0])
+		except ValueError:
+			header = {}
+		if header.get('base') != fileStamp(self.settingsFile):
+			logging.warning('Ignoring journal %s, it does not belong to %s' % (self.name, self.settingsFile))
+			return 0
+
+		for line in lines[1:]:
+			try:
+				record = json.loads(line)
+			except ValueError:
+				# An incomplete record at the end, the write didn't complete.
+				break
+			applyJournalRecord(tree.getroot(), record)
+			count += 1
+
+		return count
+
+	def remove(self):
+		if path.isfile(self.name):
+			remove(self.name)
+			fsyncDir(self.name)
+		self.size = 0
+
+## The settings stored as one file per child of /Settings.
+#
+# A change then only rewrites the file of the top-level group it is in. The
+# manifest lists the files which belong together, with the settings version
+# and unique id. A changed shard is written to a new file, with the next
+# generation in its name, and the manifest is only replaced when all shards
+# are on disk. So a crash at any point leaves a consistent set of files. Files
+# which are not in the manifest are removed afterwards.
+class ShardedStorage:
+	manifestName = 'manifest.json'
+	header = ("<?xml version='1.0' encoding='%s'?>\n" % settingsEncoding).encode(settingsEncoding)
+
+	def __init__(self, directory):
+		self.directory = directory
+		self.manifestFile = os.path.join(directory, self.manifestName)
+		self._manifest = None
+		## The data of the shards as last written, by tag.
+		self._written = {}
+
+	def exists(self):
+		return path.isfile(self.manifestFile)
+
+	def manifest(self):
+		if self._manifest is None:
+			with open(self.manifestFile, 'rb') as f:
+				self._manifest = json.loads(f.read().decode(settingsEncoding))
+		return self._manifest
+
+	## The settings of all shards as a single tree, like the settings file.
+	def load(self, parser = None):
+		manifest = self.manifest()
+		root = etree.Element(settingsRootName)
+		root.set(settingsTag, manifest['version'])
+		root.set(uniqueIdTag, manifest['unique-id'])
+		for tag, name in sorted(manifest['shards'].items()):
+			root.append(etree.parse(os.path.join(self.directory, name), parser).getroot())
+		return etree.ElementTree(root)
+
+	def _changed(self, tag, data, shards):
+		written = self._written.get(tag)
+		if written is None and tag in shards:
+			try:
+				with open(os.path.join(self.directory, shards[tag]), 'rb') as f:
+					written = f.read()[len(self.header):]
+			except OSError:
+				pass
+		return written != data
+
+	## Write the shards which changed, shards are tag and data of the elements
+	# of all children of /Settings. All of them are written with rewrite set.
+	# Returns the number of bytes written and the time it took to write and to
+	# sync them.
+	def write(self, version, uniqueId, shards, rewrite = False):
+		if not path.isdir(self.directory):
+			os.makedirs(self.directory)
+		old = self.manifest()['shards'] if self.exists() else {}
+		generation = self._manifest['generation'] + 1 if self.exists() else 1
+		manifest = {'version': version, 'unique-id': uniqueId, 'generation': generation, 'shards': {}}
+
+		files = []
+		written = {}
+		for tag, data in shards:
+			if not rewrite and not self._changed(tag, data, old):
+				manifest['shards'][tag] = old[tag]
+				continue
+			name = '%s.%d.xml' % (tag, generation)
+			files.append((os.path.join(self.directory, name), self.header + data))
+			manifest['shards'][tag] = name
+			written[tag] = data
+
+		# The manifest goes last, it makes the new shards the current ones.
+		files.append((self.manifestFile + '.new', json.dumps(manifest, indent = 1, sort_keys = True).encode(settingsEncoding)))
+		size = 0
+		writeTime = 0
+		fsyncTime = 0
+		for name, data in files:
+			start = time.monotonic()
+			with open(name, 'wb') as fp:
+				fp.write(data)
+				fp.flush()
+				flushed = time.monotonic()
+				os.fsync(fp.fileno())
+			size += len(data)
+			writeTime += flushed - start
+			fsyncTime += time.monotonic() - flushed
+
+		start = time.monotonic()
+		rename(self.manifestFile + '.new', self.manifestFile)
+		fsyncDir(self.manifestFile)
+		self._manifest = manifest
+		self._written = {tag: written.get(tag, self._written.get(tag)) for tag in manifest['shards']}
+		fsyncTime += time.monotonic() - start
+
+		self.removeUnused()
+		return size, writeTime, fsyncTime
+
+	## Remove the files which are not in the manifest.
+	def removeUnused(self):
+		used = set(self.manifest()['shards'].values()) | {self.manifestName}
+		for name in os.listdir(self.directory):
+			if name not in used:
+				remove(os.path.join(self.directory, name))
+
+	def remove(self):
+		if path.isdir(self.directory):
+			for name in os.listdir(self.directory):
+				remove(os.path.join(self.directory, name))
+			os.rmdir(self.directory)
+			fsyncDir(self.directory)
+		self._manifest = None
+		self._written = {}
+
+def fsyncDir(name):
+	fd = os.open(os.path.normpath(os.path.dirname(name)), 0)
+	os.fsync(fd)
+	os.close(fd)
+
+## The files in the settings.d directory, by name, size and modification time.
+def settingsDirManifest(path):
+	try:
+		names = sorted(os.listdir(path))
+	except OSError:
+		return ()
+	ret = []
+	for name in names:
+		try:
+			st = os.stat(os.path.join(path, name))
+		except OSError:
+			continue
+		ret.append((name, st.st_size, st.st_mtime_ns))
+	return tuple(ret)
+
+## What the settings from the settings.d directory depend on: the manifest and
+# a hash of the contents of the files. The contents are hashed as well, since
+# an image can contain files with the same size and modification time but
+# other contents.
+def settingsDirKey(path):
+	manifest = settingsDirManifest(path)
+	digest = hashlib.sha256()
+	for name, _size, _mtime in manifest:
+		try:
+			with open(os.path.join(path, name), 'rb') as f:
+				digest.update(f.read())
+		except OSError:
+			pass
+	return (manifest, digest.hexdigest())
+
+## The shard files can change without the manifest changing, so the stamps of
+# the shards listed in the manifest are part of the key as well.
+def shardsKey(directory, manifest):
+	shards = json.loads(manifest.decode(settingsEncoding))['shards']
+	key = []
+	for tag, name in sorted(shards.items()):
+		st = os.stat(os.path.join(directory, name))
+		key.append((name, st.st_ino, st.st_size, st.st_mtime_ns))
+	return tuple(key)
+
+## The records of a startup snapshot for everything below the group.
+# A group is a tuple with only its path, a setting has its path, type, value
+# and attributes, in the order of the settings file.
+def snapshotRecords(group, records):
+	for _tag, isSetting, id in group._order:
+		if isSetting:
+			setting = group._settings[id]
+			type = setting.type
+			records.append((setting._object_path, type,
+				convertToType(type, setting.value), convertToType(type, setting.default),
+				convertToType(type, setting.min), convertToType(type, setting.max), setting.silent))
+		else:
+			# Groups without settings are left out, like in the settings file.
+			child = group._children[id]
+			childRecords = snapshotRecords(child, [])
+			if childRecords or not child._removable:
+				records.append((child._object_path,))
+				records.extend(childRecords)
+	return records
+
+## Create the settings objects from the records of a startup snapshot, like
+# parseXmlFile does from the settings file.
+def loadSnapshotRecords(records, root):
+	for record in records:
+		if len(record) == 1:
+			root.createGroups(record[0])
+			continue
+		path, type, value, default, min, max, silent = record
+		group = root.createGroupsForObjectPath(path)
+		setting = group._newSettingObject(path.rsplit("/", 1)[-1])
+		setting.value = convertToType(type, value)
+		setting.setAttributes(convertToType(type, default), type, convertToType(type, min),
+								convertToType(type, max), silent)
+		group.addSettingObject(setting)
+
+## A file with data which is only valid as long as what it was derived from
+# did not change.
+#
+# The data is stored with marshal together with a key describing what it
+# depends on and a checksum. Data with another key is ignored, so is a corrupt
+# file. Subclasses define the magic and key(), which returns what the data
+# depends on.
+class BinaryCache:
+	magic = None
+
+	def __init__(self, name):
+		self.name = name
+
+	## Returns the data, or None if there is no valid data.
+	def load(self):
+		try:
+			with open(self.name, 'rb') as f:
+				data = f.read()
+		except OSError:
+			return None
+
+		try:
+			header = len(self.magic) + 4
+			if data[:len(self.magic)] != self.magic:
+				raise ValueError('wrong file type')
+			crc, = struct.unpack('>I', data[len(self.magic):header])
+			payload = data[header:]
+			if zlib.crc32(payload) != crc:
+				raise ValueError('checksum mismatch')
+			key, records = marshal.loads(payload)
+			if key != self.key():
+				logging.info('%s is outdated' % self.name)
+				return None
+			return records
+		except Exception as e:
+			logging.warning('ignoring %s: %s' % (self.name, e))
+			return None
+
+	def write(self, records):
+		payload = marshal.dumps((self.key(), records))
+		data = self.magic + struct.pack('>I', zlib.crc32(payload)) + payload
+		tmp = self.name + '.new'
+		with open(tmp, 'wb') as f:
+			f.write(data)
+		os.replace(tmp, self.name)
+		return True
+
+## Binary copy of the settings objects.
+#
+# Parsing and migrating the settings file and creating the settings from it
+# takes quite some time at startup. If the settings file, the settings.d files
+# and the version of localsettings are still the same as when the snapshot
+# was written, the settings are created from the snapshot instead. The
+# snapshot is written from the writer thread, after the settings file.
+class StartupSnapshot(BinaryCache):
+	magic = b'LSSNAP1\n'
+
+	## With sharded storage, settingsFile is the manifest and shardsDir the
+	# directory with the shards.
+	def __init__(self, name, settingsFile, settingsDir, shardsDir = None):
+		super().__init__(name)
+		self.settingsFile = settingsFile
+		self.settingsDir = settingsDir
+		self.shardsDir = shardsDir
+
+	def key(self):
+		with open(self.settingsFile, 'rb') as f:
+			st = os.fstat(f.fileno())
+			data = f.read()
+		key = (version, settingsVersion, st.st_size, st.st_mtime_ns, hashlib.sha256(data).hexdigest(),
+				settingsDirKey(self.settingsDir))
+		if self.shardsDir is not None:
+			key += (shardsKey(self.shardsDir, data),)
+		return key
+
+## The parsed settings.d files. They hardly ever change, so they are only
+# parsed again when settingsDirKey changes.
+class SettingsDirCache(BinaryCache):
+	magic = b'LSDEFS2\n'
+
+	def __init__(self, name, settingsDir):
+		super().__init__(name)
+		self.settingsDir = settingsDir
+
+	def key(self):
+		return (version, settingsDirKey(self.settingsDir))
+
+## Converts the default, min and max of a setting to its type and checks them.
+# Returns an AddSettingError and the converted default, min and max.
+def settingAttributes(itemType, defaultValue, minimum, maximum):
+	if itemType not in supportedTypes:
+		return AddSettingError.UnknownType, None, None, None
+
+	value = convertToType(itemType, defaultValue)
+	if value is None:
+		return AddSettingError.InvalidDefault, None, None, None
+	min = convertToType(itemType, minimum)
+	max = convertToType(itemType, maximum)
+
+	if not isinstance(value, str):
+		if min == 0 and max == 0:
+			min = None
+			max = None
+
+		if min is not None and value < min:
+			return AddSettingError.DefaultOutOfRange, None, None, None
+
+		if max is not None and value > max:
+			return AddSettingError.DefaultOutOfRange, None, None, None
+	else:
+		min = None
+		max = None
+
+	return AddSettingError.NoError, value, min, max
 
 def toBool(val):
 	if not isinstance(val, str):
@@ -753,10 +1791,14 @@ def toBool(val):
 	return val.lower() == 'true'
 
 ## Load settings from text file
-def loadSettingsFile(name, settingsGroup):
+# The definitions are added to the dictionary by path, as a list of tuples of
+# the default, type, min, max and silent flag, in the order they are loaded.
+# Like with addSetting, a later definition of a setting replaces an earlier
+# one, unless its type differs from the setting's.
+def loadSettingsFile(name, defaults):
 	with open(name, 'r') as f:
 		for line in f:
-			v = re.sub('#.*', '', line).strip().split()
+			v = line.partition('#')[0].split()
 			if not v:
 				continue
 
@@ -778,41 +1820,57 @@ def loadSettingsFile(name, settingsGroup):
 			# But lets at least encourage quoting strings so empty string are
 			# supported and it allows supporting it if needed.
 			if itemType == "s":
-				m = re.search(r'^"(.*)"$', defVal)
-				if m:
-					defVal = m[1]
+				if len(defVal) >= 2 and defVal[0] == '"' and defVal[-1] == '"':
+					defVal = defVal[1:-1]
 				else:
 					logging.warning("please quote string types for " + path)
 
-			defVal = convertToType(itemType, defVal)
-
-			if not isinstance(defVal, str):
-				minVal = convertToType(itemType, minVal)
-				maxVal = convertToType(itemType, maxVal)
-
-				if minVal or maxVal:
-					if defVal < minVal or defVal > maxVal:
-						raise Exception('default value out of range')
-
 			silent = toBool(silent)
 			path = path.lstrip('/')
 
-			settingsGroup.addSetting(path, defVal, itemType, minVal, maxVal, silent)
+			error, defVal, minVal, maxVal = settingAttributes(itemType, defVal, minVal, maxVal)
+			if error != AddSettingError.NoError:
+				logging.error('invalid setting %s: %s', path, error.name)
+				continue
+
+			defaults.setdefault(path, []).append((defVal, itemType, minVal, maxVal, silent))
 
 ## Load settings from each file in dir
-def loadSettingsDir(path, dictionary):
+def loadSettingsDir(path, defaults):
 	try:
 		names = os.listdir(path)
 	except:
-		return
+		return defaults
 
 	for name in names:
 		filename = os.path.join(path, name)
 		try:
-			loadSettingsFile(filename, dictionary)
+			loadSettingsFile(filename, defaults)
 		except Exception as ex:
 			logging.error('error loading %s: %s' % (filename, str(ex)))
 
+	return defaults
+
+## Write the settings as a single settings file, from either storage layout.
+def exportSettings(pathSettings, name):
+	directory = pathSettings + LocalSettings.shardsDir
+	if ShardedStorage(directory).exists():
+		# A running localsettings can replace the shards in the meantime.
+		for attempt in range(3):
+			try:
+				tree = ShardedStorage(directory).load()
+				break
+			except OSError:
+				if attempt == 2:
+					raise
+	else:
+		fileSettings = pathSettings + LocalSettings.fileSettings
+		tree = etree.parse(fileSettings)
+		SettingsJournal(fileSettings + LocalSettings.journalFileExtension, fileSettings).replay(tree)
+
+	with open(name, 'wb') as f:
+		f.write(etree.tostring(tree, encoding = settingsEncoding, pretty_print = True, xml_declaration = True))
+
 def getVrmUniqueId():
 	try:
 		return check_output("/sbin/get-unique-id").decode("ascii").strip()
@@ -820,27 +1878,517 @@ def getVrmUniqueId():
 		pass
 	return ''
 
+## How long the phases of the startup took, measured with a monotonic clock.
+# A phase ends with a call to end(), which records the time since the end of the
+# previous phase. So all phases together cover the whole startup.
+class StartupProfile:
+	def __init__(self):
+		self.phases = []
+		self._start = time.monotonic()
+		self._last = self._start
+
+	def end(self, phase):
+		now = time.monotonic()
+		self.phases.append((phase, now - self._last))
+		self._last = now
+
+	def milliseconds(self):
+		ret = {phase: duration * 1000 for phase, duration in self.phases}
+		ret['Total'] = (self._last - self._start) * 1000
+		return ret
+
+	def log(self):
+		logging.info('Startup took %.1f ms: %s' % ((self._last - self._start) * 1000,
+						', '.join('%s %.1f ms' % (phase, duration * 1000) for phase, duration in self.phases)))
+
+## Counters and latency histograms of the D-Bus method calls, by method, by
+# sender and by top-level group, and statistics of the saves and the signals.
+#
+# Recording a call only takes a few dictionary updates, so the statistics are
+# always enabled. The number of senders is limited, calls from senders beyond
+# maxKeys are counted as 'other'.
+class Stats:
+	## Upper bounds of the latency histogram buckets in microseconds, the
+	# last bucket counts the slower calls.
+	latencyBuckets = (10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000)
+	maxKeys = 128
+
+	def __init__(self):
+		self._bounds = tuple(bound / 1e6 for bound in self.latencyBuckets)
+		self.reset()
+
+	def reset(self):
+		self.start = time.monotonic()
+		self.methods = {}
+		self.senders = {}
+		self.groups = {}
+		self.signals = {}
+		self.saves = dict.fromkeys(('Count', 'Bytes', 'SerializeTime', 'WriteTime', 'FsyncTime', 'MaxTime',
+									'JournalAppends', 'JournalBytes', 'JournalTime', 'Failed',
+									'SnapshotTime', 'SnapshotMaxTime'), 0)
+
+	## The top-level group of an object path, e.g. /Settings/Gui for
+	# /Settings/Gui/Brightness.
+	@staticmethod
+	def group(path):
+		return '/'.join(path.split('/', 3)[:3])
+
+	def _latency(self, table, key, duration):
+		entry = table.get(key)
+		if entry is None:
+			if len(table) >= self.maxKeys:
+				key = 'other'
+				entry = table.get(key)
+			if entry is None:
+				entry = table[key] = [0, 0.0, 0.0, [0] * (len(self._bounds) + 1)]
+		entry[0] += 1
+		entry[1] += duration
+		if duration > entry[2]:
+			entry[2] = duration
+		entry[3][bisect_left(self._bounds, duration)] += 1
+
+	def methodCalled(self, message, duration):
+		self._latency(self.methods, message.get_member(), duration)
+		self._latency(self.senders, message.get_sender() or '', duration)
+		self._latency(self.groups, self.group(message.get_path()), duration)
+
+	def signalSent(self, name):
+		self.signals[name] = self.signals.get(name, 0) + 1
+
+	def saved(self, size, serializeTime, writeTime, fsyncTime):
+		saves = self.saves
+		saves['Count'] += 1
+		saves['Bytes'] += size
+		saves['SerializeTime'] += serializeTime
+		saves['WriteTime'] += writeTime
+		saves['FsyncTime'] += fsyncTime
+		saves['MaxTime'] = max(saves['MaxTime'], serializeTime + writeTime + fsyncTime)
+
+	## The part of a save which blocks the mainloop, taking the snapshot of
+	# the changes which the writer thread writes.
+	def snapshotTaken(self, duration):
+		saves = self.saves
+		saves['SnapshotTime'] += duration
+		saves['SnapshotMaxTime'] = max(saves['SnapshotMaxTime'], duration)
+
+	def journalAppended(self, size, duration):
+		self.saves['JournalAppends'] += 1
+		self.saves['JournalBytes'] += size
+		self.saves['JournalTime'] += duration
+
+	def saveFailed(self):
+		self.saves['Failed'] += 1
+
+	@staticmethod
+	def _latencyToDbus(table):
+		return dbus.Dictionary({key: dbus.Dictionary({
+				'Count': dbus.UInt32(count),
+				'Time': dbus.Double(total * 1000),
+				'MaxTime': dbus.Double(max * 1000),
+				'Histogram': dbus.Array(histogram, signature = 'u'),
+			}, signature = 'sv') for key, (count, total, max, histogram) in table.items()},
+			signature = 'sv')
+
+	## The statistics as a D-Bus dictionary. The Duration since the reset is in
+	# seconds, the other times are in milliseconds.
+	def toDbus(self):
+		duration = time.monotonic() - self.start
+		saves = dbus.Dictionary({name: dbus.Double(value * 1000) if name.endswith('Time') else dbus.UInt64(value)
+								for name, value in self.saves.items()}, signature = 'sv')
+		saves['PerHour'] = dbus.Double((saves['Count'] + saves['JournalAppends']) * 3600 / duration if duration else 0)
+		return dbus.Dictionary({
+			'Duration': dbus.Double(duration),
+			'LatencyBuckets': dbus.Array(self.latencyBuckets, signature = 'u'),
+			'Methods': self._latencyToDbus(self.methods),
+			'Senders': self._latencyToDbus(self.senders),
+			'Groups': self._latencyToDbus(self.groups),
+			'Saves': saves,
+			'Signals': dbus.Dictionary({name: dbus.UInt64(count) for name, count in self.signals.items()},
+										signature = 'sv'),
+		}, signature = 'sv')
+
+stats = Stats()
+
+## The process behind a D-Bus connection.
+class SenderProcess:
+	__slots__ = ('pid', 'name', 'cmdline')
+
+	def __init__(self, pid):
+		p = psutil.Process(pid)
+		self.pid = pid
+		self.name = p.name()
+		self.cmdline = p.cmdline()
+
+## Tells the listeners when a client leaves the bus.
+#
+# Unique bus names are never reused, so whatever is kept per client can be
+# dropped once NameOwnerChanged reports that its unique name has no owner
+# anymore. The signal is subscribed to on the first watch.
+class ClientTracker:
+	def __init__(self):
+		self._connection = None
+		self._listeners = []
+
+	## The listener is called with the unique name of a client leaving the bus.
+	def addListener(self, listener):
+		self._listeners.append(listener)
+
+	def watch(self, connection):
+		if self._connection is connection:
+			return
+		self._connection = connection
+		connection.add_signal_receiver(self._nameOwnerChanged, signal_name = 'NameOwnerChanged',
+										dbus_interface = 'org.freedesktop.DBus', path = '/org/freedesktop/DBus',
+										bus_name = 'org.freedesktop.DBus')
+
+	def _nameOwnerChanged(self, name, oldOwner, newOwner):
+		if newOwner or not name.startswith(':'):
+			return
+		for listener in self._listeners:
+			listener(name)
+
+clientTracker = ClientTracker()
+
+## Decides which clients may change which settings.
+#
+# A rule is a function getting the SenderProcess of the client, or None when it
+# could not be determined, and returns whether the change is allowed. Paths
+# without a rule can be changed by everyone.
+#
+# The process of a client is asked for asynchronously, so a slow bus daemon
+# doesn't block the other clients. It is cached by unique bus name, and dropped
+# when the client leaves the bus, see ClientTracker.
+class AccessPolicy:
+	def __init__(self, clients):
+		self._rules = {}
+		self._processes = {}
+		self._waiting = {}
+		self._clients = clients
+		clients.addListener(self._clientLeft)
+
+	def addRule(self, path, rule):
+		self._rules[path] = rule
+
+	## Calls done with a function telling whether the change of a path is
+	# allowed. When none of the paths has a rule, that is done right away.
+	def authorize(self, connection, sender, paths, done):
+		if not any(settingPath in self._rules for settingPath in paths):
+			done(lambda path: True)
+			return
+
+		def processKnown(process):
+			def allowed(path):
+				rule = self._rules.get(path)
+				return rule is None or rule(process)
+			done(allowed)
+
+		self.lookup(connection, sender, processKnown)
+
+	## Calls done with the SenderProcess of the unique bus name, or None.
+	def lookup(self, connection, sender, done):
+		if sender in self._processes:
+			done(self._processes[sender])
+			return
+
+		if sender in self._waiting:
+			self._waiting[sender].append(done)
+			return
+		self._waiting[sender] = [done]
+
+		# Subscribe before asking, so leaving the bus after the reply is seen.
+		self._clients.watch(connection)
+
+		def reply(pid):
+			try:
+				process = SenderProcess(pid)
+			except psutil.Error:
+				process = None
+			self._found(sender, process)
+
+		def error(e):
+			logging.error("could not find the pid for %s: %s", sender, e)
+			self._found(sender, None)
+
+		connection.call_async('org.freedesktop.DBus', '/org/freedesktop/DBus', 'org.freedesktop.DBus',
+								'GetConnectionUnixProcessID', 's', (sender,), reply, error)
+
+	def _found(self, sender, process):
+		if process is not None:
+			self._processes[sender] = process
+		for done in self._waiting.pop(sender):
+			done(process)
+
+	def _clientLeft(self, name):
+		self._processes.pop(name, None)
+
+## The venus-platform api must be used to change the SecurityProfile, only the
+# network reset of the button handler is allowed to reset it.
+def securityProfileRule(process):
+	if process is None:
+		return False
+	cmd = process.cmdline
+	is_reset = len(cmd) >= 2 and cmd[0] == "/usr/bin/python3" and cmd[-1] == "/opt/victronenergy/venus-button-handler/network-reset"
+	if process.name != "venus-platform" and not is_reset:
+		print("disallowing Security Profile change from " + str(cmd))
+		return False
+	return True
+
+accessPolicy = AccessPolicy(clientTracker)
+accessPolicy.addRule("/Settings/System/SecurityProfile", securityProfileRule)
+
+## Returns a callback replying to an asynchronous D-Bus method call with the
+# result of function, or with the exception it raises.
+def replyWith(reply, error, function):
+	def callback(*args):
+		try:
+			result = function(*args)
+		except Exception as e:
+			error(e)
+			return
+		reply(result)
+	return callback
+
+## Logs the changes of the settings, without flooding the log.
+#
+# The first change of a setting is logged as is. Further changes of it within
+# the interval are only counted and logged as a single line when the interval
+# ends, so a client changing a setting many times a second costs a log line
+# per interval. An interval of 0 logs every change.
+class ChangeLog:
+	interval = 10
+
+	def __init__(self):
+		self._logged = {}
+		self._suppressed = {}
+		self._timer = None
+
+	def changed(self, path, old, new):
+		if self.interval <= 0:
+			logging.info('Setting %s changed. Old: %s, New: %s', path, old, new)
+			return
+
+		entry = self._suppressed.get(path)
+		if entry is not None:
+			entry[0] += 1
+			entry[1] = new
+			return
+
+		now = time.monotonic()
+		last = self._logged.get(path)
+		if last is not None and now - last < self.interval:
+			self._suppressed[path] = [1, new]
+			if self._timer is None:
+				self._timer = GLib.timeout_add(math.ceil(self.interval * 1000), self._timeout)
+			return
+
+		self._logged[path] = now
+		logging.info('Setting %s changed. Old: %s, New: %s', path, old, new)
+
+	## Logs the suppressed changes.
+	def flush(self):
+		now = time.monotonic()
+		for settingPath, (count, value) in self._suppressed.items():
+			logging.info('Setting %s changed %d times, last value %s', settingPath, count, value)
+			self._logged[settingPath] = now
+		self._suppressed.clear()
+		self._logged = {settingPath: last for settingPath, last in self._logged.items() if now - last < self.interval}
+
+	def _timeout(self):
+		self.flush()
+		if self._suppressed or self._logged:
+			return True
+		self._timer = None
+		return False
+
+changeLog = ChangeLog()
+
+## Decides when the changed settings are saved.
+#
+# A save is done when there were no changes for the quiet period, but no
+# later than the maximum deferral after the first unsaved change. Saves are
+# at least the minimum interval apart. When a save is forced by the maximum
+# deferral, the settings keep changing, so the next forced save is deferred
+# twice as long, up to the maximum backoff. That drops back after a save
+# following a quiet period. Only the saves done by the scheduler itself count
+# for the backoff, not those forced by e.g. Flush. All times are in seconds.
+class SaveScheduler:
+	quietPeriod = 2
+	maxDeferral = 10
+	minInterval = 1
+	maxBackoff = 60
+
+	## The clock and timer functions can be replaced, for testing.
+	def __init__(self, save, quietPeriod = quietPeriod, clock = time.monotonic,
+					timeoutAdd = GLib.timeout_add, sourceRemove = GLib.source_remove):
+		self._save = save
+		self.quietPeriod = quietPeriod
+		self._clock = clock
+		self._timeoutAdd = timeoutAdd
+		self._sourceRemove = sourceRemove
+		self._interval = 0
+		self._scheduled = False
+		self._eventId = None
+		self._firstChange = None
+		self._lastChange = None
+		self._lastSave = None
+
+	def pending(self):
+		return self._firstChange is not None
+
+	def changed(self):
+		now = self._clock()
+		if self._firstChange is None:
+			self._firstChange = now
+		self._lastChange = now
+		if self._eventId is None:
+			self._arm(now)
+
+	## Must be called on every save, also when it is not done by the scheduler.
+	def saved(self):
+		now = self._clock()
+		if self._scheduled and self._firstChange is not None:
+			if self._lastChange + self.quietPeriod <= now:
+				self._interval = 0
+			else:
+				self._interval = min(max(self._interval * 2, self.maxDeferral), self.maxBackoff)
+		self._lastSave = now
+		self._firstChange = None
+		self._lastChange = None
+		if self._eventId is not None:
+			self._sourceRemove(self._eventId)
+			self._eventId = None
+
+	## When the pending changes are to be saved. The backoff only delays the
+	# saves forced by the maximum deferral, not those after a quiet period.
+	def _due(self):
+		deferral = self._firstChange + self.maxDeferral
+		if self._lastSave is None:
+			return min(self._lastChange + self.quietPeriod, deferral)
+		deferral = max(deferral, self._lastSave + self._interval)
+		due = min(self._lastChange + self.quietPeriod, deferral)
+		return max(due, self._lastSave + self.minInterval)
+
+	def _arm(self, now):
+		self._eventId = self._timeoutAdd(max(0, math.ceil((self._due() - now) * 1000)), self._timeout)
+
+	def _timeout(self):
+		self._eventId = None
+		now = self._clock()
+		if self._firstChange is None:
+			return False
+		if now < self._due():
+			self._arm(now)
+			return False
+		self._scheduled = True
+		try:
+			self._save()
+		finally:
+			self._scheduled = False
+		return False
+
+## Writes the settings to disk from a background thread.
+#
+# Serializing the settings and syncing them to disk can take quite some time on
+# slow storage. Doing that on the mainloop would block all D-Bus calls in the
+# meantime. The jobs are executed in the order they are submitted, the done
+# callback is invoked from the mainloop with the result of the job, or None
+# when the job failed.
+class SettingsWriter:
+	def __init__(self):
+		self._queue = queue.Queue()
+		self._idle = threading.Condition()
+		self._pending = 0
+		self._thread = threading.Thread(target=self._run, name="settings-writer", daemon=True)
+		self._thread.start()
+
+	def submit(self, job, done = None):
+		with self._idle:
+			self._pending += 1
+		self._queue.put((job, done))
+
+	def busy(self):
+		with self._idle:
+			return self._pending > 0
+
+	## Block until all submitted jobs are finished.
+	def wait(self):
+		with self._idle:
+			while self._pending:
+				self._idle.wait()
+
+	def _run(self):
+		while True:
+			job, done = self._queue.get()
+			try:
+				result = job()
+			except Exception:
+				logging.exception("Writing the settings failed")
+				result = None
+
+			with self._idle:
+				self._pending -= 1
+				self._idle.notify_all()
+
+			if done:
+				GLib.idle_add(self._done, done, result)
+
+	def _done(self, done, result):
+		done(result)
+		return False
+
 ## The main function.
 class LocalSettings:
 	dbusName = 'com.victronenergy.settings'
 	fileSettings = 'settings.xml'
 	newFileExtension = '.new'
 	importFileExtension = '.import'
+	journalFileExtension = '.journal'
+	snapshotFileExtension = '.snapshot'
+	settingsDirCacheExtension = '.defaults'
+	shardsDir = 'settings'
 	sysSettingsDir = '/etc/venus/settings.d'
+	## Compact the journal into the settings file when it grows beyond this size
+	journalMaxSize = 64 * 1024
+	## or when it hasn't been compacted for this many seconds.
+	journalCompactInterval = 3600
+
+	def __init__(self, pathSettings, timeoutSaveSettingsTime, useJournal = False, virtualTree = False,
+					itemsChangedWindow = 0, propertiesChanged = True, settingsDir = None, sharded = False):
+		self.startupProfile = StartupProfile()
 
-	def __init__(self, pathSettings, timeoutSaveSettingsTime):
 		# set the settings path
 		self.fileSettings = pathSettings + self.fileSettings
 		self.newFileSettings = self.fileSettings + self.newFileExtension
 		self.importFileSettings = self.fileSettings + self.importFileExtension
-		self.timeoutSaveSettingsTime = timeoutSaveSettingsTime
-		self.timeoutSaveSettingsEventId = None
+		## Set when the settings are stored as one file per top-level group.
+		self.shards = ShardedStorage(pathSettings + self.shardsDir) if sharded else None
+		## Saves after timeoutSaveSettingsTime without changes, see SaveScheduler
+		# for the other limits.
+		self.saveScheduler = SaveScheduler(self.writeToXml, timeoutSaveSettingsTime)
+		if settingsDir is not None:
+			self.sysSettingsDir = settingsDir
 		self.rootGroup = None
 		self.settingsGroup = None
+		self.useJournal = useJournal
+		self.virtualTree = virtualTree
+		self.journal = SettingsJournal(self.fileSettings + self.journalFileExtension, self.fileSettings)
+		self.journalCompactTime = time.monotonic()
+		## Settings changed since the last save, by path. None if removed.
+		self.changedSettings = {}
+		self.writer = SettingsWriter()
+		if sharded:
+			self.startupSnapshot = StartupSnapshot(self.fileSettings + self.snapshotFileExtension,
+													self.shards.manifestFile, self.sysSettingsDir, self.shards.directory)
+		else:
+			self.startupSnapshot = StartupSnapshot(self.fileSettings + self.snapshotFileExtension,
+													self.fileSettings, self.sysSettingsDir)
+		self.settingsDirCache = SettingsDirCache(self.fileSettings + self.settingsDirCacheExtension,
+												self.sysSettingsDir)
 
 		# VRM portal id is stored in settings file so we can detect
 		# when settings is transferred to another device.
 		self.serial = getVrmUniqueId()
+		self.startupProfile.end('UniqueId')
 
 		# Print the logscript version
 		logging.info('Localsettings version is: 0x%04x' % version)
@@ -849,6 +2397,87 @@ class LocalSettings:
 			print('Error path %s does not exist!' % pathSettings)
 			sys.exit(errno.ENOENT)
 
+		# Use the snapshot of the last run if nothing changed since then.
+		records = None
+		if self.settingsExist() and not path.isfile(self.importFileSettings) and \
+				not self.journal.exists():
+			records = self.startupSnapshot.load()
+			self.startupProfile.end('Snapshot')
+		self.loadedFromSnapshot = records is not None
+		self.snapshotCurrent = self.loadedFromSnapshot
+		if self.loadedFromSnapshot:
+			logging.info('Loading the settings from %s' % self.startupSnapshot.name)
+		else:
+			self.prepareSettingsFile()
+		## The size of the journal as far as the mainloop knows, it is updated
+		# when the writes are done. From here on the journal is only used by
+		# the writer thread.
+		self.journalSize = self.journal.size
+
+		# connect to the SessionBus if there is one. System otherwise
+		self.dbusConn = dbus.SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in environ else dbus.SystemBus()
+		self.exporter = BusExporter(self.dbusConn, self.virtualTree)
+		self.rootGroup = RootObject(self.exporter, "/", None, removable = False)
+		self.rootGroup.itemsChangedWindow = itemsChangedWindow
+		self.rootGroup.propertiesChanged = propertiesChanged
+		self.settingsGroup = self.rootGroup.createGroups("/Settings")
+		self.settingsGroup._removable = False
+		devices = DevicesGroup(self.exporter, "/Settings/Devices", self.settingsGroup, removable = False)
+		self.settingsGroup.addGroup("Devices", devices)
+		if self.loadedFromSnapshot:
+			loadSnapshotRecords(records, self.rootGroup)
+		else:
+			parseXmlTree(self.loadTree(etree.XMLParser(remove_blank_text=True)), self.rootGroup)
+		self.startupProfile.end('Objects')
+
+	def settingsExist(self):
+		if self.shards:
+			return self.shards.exists()
+		return path.isfile(self.fileSettings)
+
+	## The settings as a single tree, from the settings file or the shards.
+	def loadTree(self, parser = None):
+		if self.shards:
+			return self.shards.load(parser)
+		return etree.parse(self.fileSettings, parser)
+
+	def removeSettings(self):
+		if self.shards:
+			self.shards.remove()
+		else:
+			remove(self.fileSettings)
+
+	## Converts the settings to the layout in use, when they are only
+	# stored in the other one. The other one is removed afterwards.
+	def convertSettings(self):
+		other = ShardedStorage(path.join(path.dirname(self.fileSettings), self.shardsDir))
+		if self.settingsExist():
+			# A copy in the other layout was left behind by an interrupted
+			# conversion and is older than the settings in use.
+			if self.shards and path.isfile(self.fileSettings):
+				logging.warning('Removing %s, the settings are in %s' % (self.fileSettings, self.shards.directory))
+				remove(self.fileSettings)
+			elif not self.shards and other.exists():
+				logging.warning('Removing %s, the settings are in %s' % (other.directory, self.fileSettings))
+				other.remove()
+			return
+		if self.shards and path.isfile(self.fileSettings):
+			logging.info('Converting %s to %s' % (self.fileSettings, self.shards.directory))
+			tree = etree.parse(self.fileSettings)
+			# The journal belongs to the settings file.
+			self.journal.replay(tree)
+			self.save(tree)
+			self.journal.remove()
+			remove(self.fileSettings)
+			return
+		if not self.shards and other.exists():
+			logging.info('Converting %s to %s' % (other.directory, self.fileSettings))
+			self.save(other.load())
+			other.remove()
+
+	## Import, replay, migrate and validate the settings file, or create an
+	# empty one, so it can be parsed.
+	def prepareSettingsFile(self):
 		if path.isfile(self.importFileSettings):
 			# Validate and migrate import file
 			try:
@@ -858,6 +2487,8 @@ class LocalSettings:
 
 				logging.info('Import file %s validated' % self.importFileSettings)
 				self.save(tree)
+				# The journal belongs to the replaced settings file.
+				self.journal.remove()
 			except Exception as e:
 				print(e)
 				logging.error('Import file %s invalid' % self.importFileSettings)
@@ -865,19 +2496,31 @@ class LocalSettings:
 			# Always remove import file.
 			remove(self.importFileSettings)
 			logging.info('%s removed' % self.importFileSettings)
+			self.startupProfile.end('Import')
+
+		self.convertSettings()
 
-		if path.isfile(self.fileSettings):
+		if self.settingsExist():
 			# Try to validate the settings file.
 			try:
-				tree = etree.parse(self.fileSettings)
+				tree = self.loadTree()
 				root = tree.getroot()
 				# NOTE: there used to be a 1.0 version once upon a time an no version at all
 				# in really old version. Since it is easier to compare integers only use the
 				# major part.
 				loadedVersionTxt = tree.xpath("string(/Settings/@version)") or "1"
 				loadedVersion = [int(i) for i in loadedVersionTxt.split('.')][0]
+				self.startupProfile.end('Parse')
+
+				# The journal contains changes on top of the settings file, in
+				# the same version as the settings file itself.
+				replayed = self.journal.replay(tree)
+				if replayed:
+					logging.info('Replayed %d changes from %s' % (replayed, self.journal.name))
+				self.startupProfile.end('Replay')
 
 				migrate.migrate(self, tree, loadedVersion)
+				self.startupProfile.end('Migrate')
 
 				logging.info('Settings file %s validated' % self.fileSettings)
 
@@ -886,15 +2529,21 @@ class LocalSettings:
 					root.set(settingsTag, settingsVersion)
 					root.set(uniqueIdTag, self.serial)
 					self.save(tree)
+				elif replayed:
+					self.save(tree)
+				self.startupProfile.end('Save')
 
 			except Exception as e:
 				print(e)
 				logging.error('Settings file %s invalid' % self.fileSettings)
-				remove(self.fileSettings)
+				self.removeSettings()
 				logging.error('%s removed' % self.fileSettings)
 
+		# Any changes in the journal are part of the settings file by now.
+		self.journal.remove()
+
 		# check if settings file is present, if not exit create a "empty" settings file.
-		if not path.isfile(self.fileSettings):
+		if not self.settingsExist():
 			logging.warning('Settings file %s not found' % self.fileSettings)
 			root = etree.Element(settingsRootName)
 			root.set(settingsTag, settingsVersion)
@@ -902,20 +2551,15 @@ class LocalSettings:
 			tree = etree.ElementTree(root)
 			self.save(tree)
 			logging.warning('Created settings file %s' % self.fileSettings)
-
-		# connect to the SessionBus if there is one. System otherwise
-		self.dbusConn = dbus.SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in environ else dbus.SystemBus()
-		self.rootGroup = RootObject(self.dbusConn, "/", None, removable = False)
-		self.settingsGroup = self.rootGroup.createGroups("/Settings")
-		self.settingsGroup._removable = False
-		devices = DevicesGroup(self.dbusConn, "/Settings/Devices", self.settingsGroup, removable = False)
-		self.settingsGroup.addGroup("Devices", devices)
-		parseXmlFile(self.fileSettings, self.rootGroup)
+			self.startupProfile.end('Create')
 
 	def claimDbusName(self):
 		print("claiming " + self.dbusName)
 		self.dbusConn.request_name(self.dbusName, flags=dbus.bus.NAME_FLAG_DO_NOT_QUEUE)
 
+	## Save a tree which doesn't come from the settings objects, like an
+	# imported or migrated settings file. The settings objects keep their
+	# children sorted themselves, see writeToXml.
 	def save(self, tree):
 
 		def recursive_sort(root):
@@ -924,36 +2568,177 @@ class LocalSettings:
 			root[:] = sorted(root, key=lambda c: c.tag)
 		recursive_sort(tree.getroot())
 
+		if self.shards:
+			root = tree.getroot()
+			self.shards.write(root.get(settingsTag, '1'), root.get(uniqueIdTag, ''),
+				[(child.tag, xmlChildData(child)) for child in root if isinstance(child.tag, str)], rewrite = True)
+			return
+
+		self.writeFile(etree.tostring(tree, encoding = settingsEncoding, pretty_print = True, xml_declaration = True))
+
+	## Returns the number of bytes written and the time it took to write and to
+	# sync them.
+	def writeFile(self, data):
+		start = time.monotonic()
 		with open(self.newFileSettings, 'wb') as fp:
-			tree.write(fp, encoding = settingsEncoding, pretty_print = True, xml_declaration = True)
+			fp.write(data)
 			fp.flush()
+			written = time.monotonic()
 			os.fsync(fp.fileno())
 			rename(self.newFileSettings, self.fileSettings)
-
-			dst_dir = os.path.normpath(os.path.dirname(self.fileSettings))
-			fd = os.open(dst_dir, 0)
-			os.fsync(fd)
-			os.close(fd)
+			fsyncDir(self.fileSettings)
+		return len(data), written - start, time.monotonic() - written
 
 	## The callback method for saving the settings-xml-file.
-	# Calls the parseDictionaryToXmlFile with the dictionary settings and settings-xml-filename.
-	def writeToXml(self):
-		if self.timeoutSaveSettingsEventId:
-			GLib.source_remove(self.timeoutSaveSettingsEventId)
-		self.timeoutSaveSettingsEventId = None
-		writeToXmlFile(self, self.settingsGroup, self.serial)
+	# Takes a snapshot of the settings, the actual writing is done by the
+	# writer thread.
+	# In journal mode only the changed settings are appended to the journal,
+	# unless the journal needs to be compacted or compact is set.
+	#
+	# The settings objects are only used from the mainloop, so the snapshot is
+	# taken here: the records of the changed settings, or the elements of the
+	# groups in the path of the changes, the others are cached. Its time is in
+	# the SnapshotTime of the statistics.
+	def writeToXml(self, compact = False):
+		self.saveScheduler.saved()
+
+		changes = self.changedSettings
+		self.changedSettings = {}
+
+		if self.useJournal and not compact and self.journalSize < self.journalMaxSize and \
+				time.monotonic() - self.journalCompactTime < self.journalCompactInterval:
+			if changes:
+				start = time.monotonic()
+				records = [journalRecord(settingPath, setting) for settingPath, setting in changes.items()]
+				stats.snapshotTaken(time.monotonic() - start)
+				self.writer.submit(partial(self._appendJournal, records), self._journalWritten)
+			return
+
+		self.journalCompactTime = time.monotonic()
+		# Only the changed parts of the settings are serialized again.
+		start = time.monotonic()
+		if self.shards:
+			snapshot = self.settingsGroup.xmlChildren()
+		else:
+			snapshot = self.settingsGroup.xmlContent()
+		serializeTime = time.monotonic() - start
+		stats.snapshotTaken(serializeTime)
+		self.writer.submit(partial(self._writeSnapshot, snapshot, serializeTime), self._settingsWritten)
+
+	## Runs in the writer thread. Returns the number of bytes written and the
+	# time it took to serialize, write and sync them.
+	def _writeSnapshot(self, snapshot, serializeTime):
+		start = time.monotonic()
+		if self.shards:
+			size, writeTime, fsyncTime = self.shards.write(settingsVersion, self.serial, snapshot)
+		else:
+			size, writeTime, fsyncTime = writeToXmlFile(self, snapshot, self.serial)
+		serializeTime += time.monotonic() - start - writeTime - fsyncTime
+		self.journal.remove()
+		return size, serializeTime, writeTime, fsyncTime
+
+	## Runs in the writer thread. Returns the number of bytes written, the
+	# time it took and the size of the journal.
+	def _appendJournal(self, records):
+		start = time.monotonic()
+		size = self.journal.append(records)
+		return size, time.monotonic() - start, self.journal.size
+
+	def _journalWritten(self, result):
+		# The changes are lost when the journal could not be written, so make
+		# sure the next save writes all settings.
+		if result is None:
+			self.journalCompactTime = -self.journalCompactInterval
+			stats.saveFailed()
+			return
+		size, duration, self.journalSize = result
+		stats.journalAppended(size, duration)
+
+	def _settingsWritten(self, result):
+		if result is None:
+			logging.error('Settings file %s not written' % self.fileSettings)
+			stats.saveFailed()
+			return
+		# _writeSnapshot removed the journal.
+		self.journalSize = 0
+		stats.saved(*result)
+
+	## Wait till the writer thread has written all changes to disk.
+	# The writer thread is idle then, so the size of the journal can be taken
+	# from it, the mainloop may not run the done callbacks anymore.
+	def waitForWrites(self):
+		self.writer.wait()
+		self.journalSize = self.journal.size
 
 	## Method for starting the time-out for saving to the settings-xml-file.
-	# Starts the time-out. Changes during x time are collected before
-	# the settings-xml-file is saved.
+	# Changes are collected till the SaveScheduler decides to save them.
 	def startTimeoutSaveSettings(self):
-		if self.timeoutSaveSettingsEventId is not None:
-			return
-		self.timeoutSaveSettingsEventId = GLib.timeout_add(self.timeoutSaveSettingsTime * 1000,
-														self.writeToXml)
+		self.saveScheduler.changed()
+
+	## Save the pending changes now, done is called from the mainloop once
+	# they are on disk. The writer thread runs the jobs in order, so that is
+	# when a job submitted after the save is done.
+	def flush(self, done):
+		if self.saveScheduler.pending():
+			self.writeToXml()
+		self.writer.submit(lambda: True, done)
 
 	def hasPendingChanges(self):
-		return self.timeoutSaveSettingsEventId is not None
+		return self.saveScheduler.pending() or self.writer.busy()
+
+	def hasJournal(self):
+		return self.journalSize > 0
+
+	def settingChanged(self, setting):
+		self._recordChange(setting._object_path, setting)
+		self.startTimeoutSaveSettings()
+
+	def settingRemoved(self, setting):
+		self._recordChange(setting._object_path, None)
+
+	## A group is removed when it has no settings anymore. It is not in the
+	# settings file then, but the startup snapshot might still have it.
+	def groupRemoved(self, group):
+		self.snapshotCurrent = False
+		self.startTimeoutSaveSettings()
+
+	## The journal records are replayed in the order of changedSettings, so a
+	# path is moved to the end when it changes again. Otherwise e.g. removing a
+	# setting and adding settings below the same path later on could be
+	# replayed the other way around.
+	def _recordChange(self, path, setting):
+		self.changedSettings.pop(path, None)
+		self.changedSettings[path] = setting
+		self.snapshotCurrent = False
+
+	## Add the settings of the settings.d directory. The parsed files are
+	# cached, the settings are added in one go and saved together.
+	def loadDefaults(self):
+		defaults = self.settingsDirCache.load()
+		if defaults is None:
+			defaults = loadSettingsDir(self.sysSettingsDir, {})
+			self.writer.submit(partial(self.settingsDirCache.write, defaults), self._settingsDirCacheWritten)
+		changed = self.settingsGroup.addDefaults(defaults)
+		logging.info('Loaded %d settings from %s, %d added or changed' % (len(defaults), self.sysSettingsDir, changed))
+
+	def _settingsDirCacheWritten(self, result):
+		if result is None:
+			logging.error('Settings cache %s not written' % self.settingsDirCache.name)
+
+	## Write the startup snapshot for the current settings, after saving them
+	# to the settings file, since the snapshot belongs to that file.
+	def writeStartupSnapshot(self):
+		if self.snapshotCurrent:
+			return
+		if self.saveScheduler.pending() or self.hasJournal():
+			self.writeToXml(compact = True)
+		records = snapshotRecords(self.rootGroup, [])
+		self.writer.submit(partial(self.startupSnapshot.write, records), self._startupSnapshotWritten)
+		self.snapshotCurrent = True
+
+	def _startupSnapshotWritten(self, result):
+		if result is None:
+			logging.error('Startup snapshot %s not written' % self.startupSnapshot.name)
 
 def quit(mainloop):
 	mainloop.quit()
@@ -963,15 +2748,59 @@ def sig_handler(mainloop, signum, frame):
 	# events that are already queued, not future timers).
 	GLib.idle_add(quit, mainloop)
 
+## A QueueHandler which leaves formatting the record to the listener.
+class LogQueueHandler(logging.handlers.QueueHandler):
+	def prepare(self, record):
+		return record
+
+## Log through a queue, so writing the log, which might be on slow flash, is
+# done by a thread instead of blocking the main loop. The messages are also
+# formatted by that thread.
+def setupLogging():
+	logQueue = queue.SimpleQueue()
+	handler = logging.StreamHandler()
+	handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+	listener = logging.handlers.QueueListener(logQueue, handler)
+	listener.start()
+	atexit.register(listener.stop)
+
+	root = logging.getLogger()
+	root.addHandler(LogQueueHandler(logQueue))
+	root.setLevel(logging.INFO)
+
 def main(argv):
 	global localSettings
 
-	logging.getLogger().setLevel(logging.INFO)
+	setupLogging()
 
 	parser = argparse.ArgumentParser()
 	parser.add_argument('--path', help = 'use given dir as data directory', default = ".")
 	parser.add_argument('--no-delay', action = 'store_true',
 							help = "don't delay storing the settings (used by the test script)")
+	parser.add_argument('--save-quiet-period', type = float, metavar = 'S',
+							help = "save when the settings didn't change for this long (default: %s)" % SaveScheduler.quietPeriod)
+	parser.add_argument('--save-max-deferral', type = float, metavar = 'S',
+							help = "save no later than this after the first change (default: %s)" % SaveScheduler.maxDeferral)
+	parser.add_argument('--save-min-interval', type = float, metavar = 'S',
+							help = "minimum time between saves (default: %s)" % SaveScheduler.minInterval)
+	parser.add_argument('--save-max-backoff', type = float, metavar = 'S',
+							help = "maximum time between saves while the settings keep changing (default: %s)" % SaveScheduler.maxBackoff)
+	parser.add_argument('--journal', action = 'store_true',
+							help = "append changes to a journal instead of rewriting the settings file")
+	parser.add_argument('--sharded', action = 'store_true',
+							help = "store the settings as one file per top-level group")
+	parser.add_argument('--export', metavar = 'FILE',
+							help = "write the settings to a single settings file and exit")
+	parser.add_argument('--virtual-tree', action = 'store_true',
+							help = "handle all settings paths with a single D-Bus object")
+	parser.add_argument('--items-changed-window', type = int, default = 0, metavar = 'MS',
+							help = "collect changes this long for a single ItemsChanged signal (default: till idle)")
+	parser.add_argument('--no-properties-changed', action = 'store_true',
+							help = "only signal changes with ItemsChanged, not per setting")
+	parser.add_argument('--settings-dir', metavar = 'DIR',
+							help = "load the default settings from this dir (default: %s)" % LocalSettings.sysSettingsDir)
+	parser.add_argument('--change-log-interval', type = float, default = ChangeLog.interval, metavar = 'S',
+							help = "log further changes of a setting within this time as a single line, 0 logs all (default: %(default)s)")
 	parser.add_argument('-v', '--version', action = 'store_true',
 							help = "returns the program version")
 	args = parser.parse_args(argv)
@@ -983,17 +2812,46 @@ def main(argv):
 	if args.path[-1] != '/':
 		args.path += "/"
 
-	print("localsettings v%01x.%02x starting up " % (FIRMWARE_VERSION_MAJOR, FIRMWARE_VERSION_MINOR))
+	if args.sharded and args.journal:
+		parser.error("--journal can't be combined with --sharded")
 
-	DBusGMainLoop(set_as_default=True)
+	if args.export:
+		exportSettings(args.path, args.export)
+		sys.exit()
 
-	localSettings = LocalSettings(args.path, 0 if args.no_delay else 2)
+	print("localsettings v%01x.%02x starting up " % (FIRMWARE_VERSION_MAJOR, FIRMWARE_VERSION_MINOR))
+
+	changeLog.interval = args.change_log_interval
 
-	# load system default settings, note need localSettings to be ready
-	loadSettingsDir(localSettings.sysSettingsDir, localSettings.settingsGroup)
+	DBusGMainLoop(set_as_default=True)
 
-	# Not migration actually, but it needs to go somewhere. It must run after loadSettingsDir.
+	# --no-delay saves right away, unless a save option says otherwise.
+	def saveOption(value, default):
+		if value is not None:
+			return value
+		return 0 if args.no_delay else default
+
+	localSettings = LocalSettings(args.path, saveOption(args.save_quiet_period, SaveScheduler.quietPeriod),
+									args.journal, args.virtual_tree,
+									args.items_changed_window, not args.no_properties_changed, args.settings_dir,
+									args.sharded)
+	scheduler = localSettings.saveScheduler
+	scheduler.maxDeferral = saveOption(args.save_max_deferral, SaveScheduler.maxDeferral)
+	scheduler.minInterval = saveOption(args.save_min_interval, SaveScheduler.minInterval)
+	scheduler.maxBackoff = saveOption(args.save_max_backoff, SaveScheduler.maxBackoff)
+
+	# load system default settings, note need localSettings to be ready. The
+	# snapshot already contains them, if it is used.
+	if not localSettings.loadedFromSnapshot:
+		localSettings.loadDefaults()
+		localSettings.startupProfile.end('SettingsDir')
+
+	# Not migration actually, but it needs to go somewhere. It must run after loadDefaults.
 	migrate.check_security(localSettings)
+	localSettings.startupProfile.end('CheckSecurity')
+
+	localSettings.writeStartupSnapshot()
+	localSettings.startupProfile.end('StartupSnapshot')
 
 	mainloop = GLib.MainLoop()
 
@@ -1001,15 +2859,26 @@ def main(argv):
 	signal.signal(signal.SIGINT, partial(sig_handler, mainloop))
 
 	localSettings.claimDbusName()
+	localSettings.startupProfile.end('ClaimName')
+	localSettings.startupProfile.log()
 
 	mainloop.run()
 
 	logging.info("Mainloop has quit")
+	localSettings.rootGroup.sendItemsChanged()
+	localSettings.waitForWrites()
 	if localSettings.hasPendingChanges():
 		logging.info("There are pending changes; saving")
-		localSettings.writeToXml()
+		localSettings.writeToXml(compact = True)
+	elif localSettings.hasJournal():
+		logging.info("Compacting the journal")
+		localSettings.writeToXml(compact = True)
 	else:
 		logging.info("No pending changes to save")
+	localSettings.writeStartupSnapshot()
+	localSettings.waitForWrites()
+	changeLog.flush()
 	logging.info("Quitting")
 
-main(sys.argv[1:])
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -1,4 +1,6 @@
 from lxml import etree
+from collections import Counter
+from functools import lru_cache
 import os
 import subprocess
 
@@ -18,8 +20,17 @@ def create_empty_password_file():
 		print("writing password file failed")
 		pass
 
+## The xpath expressions are compiled once, instead of for every evaluation.
+@lru_cache(maxsize = 256)
+def compiled_xpath(path):
+	return etree.XPath(path)
+
+## Evaluate the (compiled) xpath expression, variables are passed as $name.
+def xpath(node, path, **variables):
+	return compiled_xpath(path)(node, **variables)
+
 def delete_from_tree(tree, path):
-	obj = tree.xpath(path)
+	obj = xpath(tree, path)
 	if not obj:
 		return
 	obj[0].getparent().remove(obj[0])
@@ -63,23 +74,35 @@ def rename_node(node, new_name):
 	delete_from_tree(parent, new_name)
 	node.tag = new_name
 
+## The values of all ClassAndVrmInstance settings, counted, so change_class
+# can find a free instance without searching the tree for every candidate.
+# Values are compared as text, like the settings file contains them.
+def class_and_vrm_instances(tree):
+	return Counter(node.text for node in xpath(tree, "/Settings/Devices/*/ClassAndVrmInstance"))
+
 # Change the class name and try to preserve the current instance.
-# The next free one will be used if already taken.
-def change_class(node, classname):
+# The next free one will be used if already taken. When changing multiple
+# classes, pass the class_and_vrm_instances of the tree, which are kept up
+# to date.
+def change_class(node, classname, taken = None):
 	try:
+		if taken is None:
+			taken = class_and_vrm_instances(node.getroottree())
+
 		old = node.text.split(":")
 		instance = int(old[1])
 		oldInstance = instance
 		oldClass = old[0]
 		node.set("default", node.get("default").replace(oldClass + ":", classname + ":"))
 
+		taken[node.text] -= 1
 		while True:
 			newValue = classname + ":" + str(instance)
-			node.text = newValue
-			result = int(node.xpath("count(/Settings/Devices/*/ClassAndVrmInstance[text() = '" + newValue + "'])"))
-			if result == 1:
+			if taken[newValue] <= 0:
 				break
 			instance += 1
+		node.text = newValue
+		taken[newValue] += 1
 
 		if oldInstance != instance:
 			print("WARNING: changing " + oldClass + ":" + str(oldInstance) + " to " + newValue)
@@ -88,9 +111,6 @@ def change_class(node, classname):
 
 ## Migrate old canbus settings
 def migrate_can_profile(localSettings, tree, version):
-	if version != 1:
-		return
-
 	if not os.path.isfile("/etc/venus/canbus_ports"):
 		return
 
@@ -102,18 +122,18 @@ def migrate_can_profile(localSettings, tree, version):
 
 	path = "/Settings/Canbus/" + interface + "/Profile"
 
-	if tree.xpath(path):
+	if xpath(tree, path):
 		return
 
 	# default to Ve.Can
 	profile = 1
 
-	if tree.xpath("/Settings/Services/LgResu/text()") == ["1"]:
+	if xpath(tree, "/Settings/Services/LgResu/text()") == ["1"]:
 		profile = 3
-	elif tree.xpath("/Settings/Services/OceanvoltMotorDrive/text()") == ["1"] or \
-		tree.xpath("/Settings/Services/OceanvoltValence/text()") == ["1"]:
+	elif xpath(tree, "/Settings/Services/OceanvoltMotorDrive/text()") == ["1"] or \
+		xpath(tree, "/Settings/Services/OceanvoltValence/text()") == ["1"]:
 		profile = 4
-	elif tree.xpath("/Settings/Services/VeCan/text()") == ["0"]:
+	elif xpath(tree, "/Settings/Services/VeCan/text()") == ["0"]:
 		profile = 0
 
 	print("Setting " + path + " to " + str(profile))
@@ -135,10 +155,7 @@ def migrate_can_profile(localSettings, tree, version):
 	delete_from_tree(tree, "/Settings/Services/VeCan")
 
 def migrate_remote_support(localSettings, tree, version):
-	if version != 1:
-		return
-
-	if tree.xpath("/Settings/System/RemoteSupport/text()") != ["1"]:
+	if xpath(tree, "/Settings/System/RemoteSupport/text()") != ["1"]:
 		return
 
 	print("Enable ssh on LAN since it was enabled by RemoteSupport")
@@ -150,9 +167,6 @@ def migrate_remote_support(localSettings, tree, version):
 	create_or_update_node(system, "SSHLocal", 1)
 
 def migrate_mqtt(localSettings, tree, version):
-	if version > 2:
-		return
-
 	settings = tree.getroot()
 	services = settings.find("Services")
 
@@ -163,12 +177,12 @@ def migrate_mqtt(localSettings, tree, version):
 	mqtt_local_insec = 0
 	mqtt_vrm = 0
 
-	if tree.xpath("/Settings/Services/Mqtt/text()") == ["1"]:
+	if xpath(tree, "/Settings/Services/Mqtt/text()") == ["1"]:
 		mqtt_local = 1
 		mqtt_local_insec = 1
 		mqtt_vrm = 1
 
-	if tree.xpath("/Settings/Services/Vrmpubnub/text()") == ["1"]:
+	if xpath(tree, "/Settings/Services/Vrmpubnub/text()") == ["1"]:
 		mqtt_vrm = 1
 
 	create_or_update_node(services, "MqttLocal", mqtt_local)
@@ -179,9 +193,6 @@ def migrate_mqtt(localSettings, tree, version):
 	delete_from_tree(tree, "/Settings/Services/Vrmpubnub")
 
 def migrate_remotesupport2(localSettings, tree, version):
-	if version > 3:
-		return
-
 	# moved, now stores ip and port
 	delete_from_tree(tree, "/Settings/System/RemoteSupportPort")
 
@@ -210,15 +221,12 @@ def elemsFloatToInt(elements):
 		elemFloatToInt(elem)
 
 def migrate_adc(localSettings, tree, version):
-	if version > 5:
-		return
-
 	# These integers were incorrectly stored as floats.
-	elemsFloatToInt(tree.xpath("/Settings/AnalogInput/Resistive/*/Function"))
-	elemsFloatToInt(tree.xpath("/Settings/AnalogInput/Temperature/*/Function"))
-	elemsFloatToInt(tree.xpath("/Settings/Tank/*/FluidType"))
-	elemsFloatToInt(tree.xpath("/Settings/Tank/*/Standard"))
-	elemsFloatToInt(tree.xpath("/Settings/Temperature/*/TemperatureType"))
+	elemsFloatToInt(xpath(tree, "/Settings/AnalogInput/Resistive/*/Function"))
+	elemsFloatToInt(xpath(tree, "/Settings/AnalogInput/Temperature/*/Function"))
+	elemsFloatToInt(xpath(tree, "/Settings/Tank/*/FluidType"))
+	elemsFloatToInt(xpath(tree, "/Settings/Tank/*/Standard"))
+	elemsFloatToInt(xpath(tree, "/Settings/Temperature/*/TemperatureType"))
 
 
 # In v2.60~13 the devices were not prefixed. So rename the nodes so that
@@ -229,10 +237,7 @@ def migrate_adc(localSettings, tree, version):
 # There is no need to keep this for a long time, since it only fixes a
 # candidate version.
 def migrate_fixup_cgwacs(localSettings, tree, version):
-	if version >= 8:
-		return
-
-	elem = tree.xpath("/Settings/CGwacs/DeviceIds/text()")
+	elem = xpath(tree, "/Settings/CGwacs/DeviceIds/text()")
 	if len(elem) == 0:
 		return
 	ids = elem[0].split(",")
@@ -242,25 +247,22 @@ def migrate_fixup_cgwacs(localSettings, tree, version):
 		if len(ident) == 0 or (ids[0] >= '0' and ids[0] <= '9'):
 			continue
 
-		dev = tree.xpath("/Settings/Devices/" + ident)
+		dev = xpath(tree, "/Settings/Devices/*[name() = $tag]", tag = ident)
 		if len(dev) == 0:
 			continue
 		rename_node(dev[0], "cgwacs_" + ident)
 
-		dev = tree.xpath("/Settings/Devices/" + ident + "_S")
+		dev = xpath(tree, "/Settings/Devices/*[name() = $tag]", tag = ident + "_S")
 		if len(dev) == 0:
 			continue
 		rename_node(dev[0], "cgwacs_" + ident + "_S")
 
 def migrate_cgwacs_deviceinstance(localSettings, tree, version):
-	if version >= 8:
-		return
-
 	devices = tree.getroot().find("Devices")
 	if devices is None:
 		devices = etree.SubElement(tree.getroot(), 'Devices')
 
-	for e in tree.xpath("/Settings/CGwacs/Devices/*"):
+	for e in xpath(tree, "/Settings/CGwacs/Devices/*"):
 		device = 'cgwacs_' + e.tag[1:] # [1:] bc old numbers prefixed with D
 
 		container = devices.find(device)
@@ -268,9 +270,9 @@ def migrate_cgwacs_deviceinstance(localSettings, tree, version):
 			container = etree.SubElement(devices, device)
 
 		# migrate device instance and phase support
-		servicetype = e.xpath('ServiceType/text()')[0]
-		deviceinstance = e.xpath('DeviceInstance/text()')[0]
-		devicetype = int(e.xpath('DeviceType/text()')[0])
+		servicetype = xpath(e, 'ServiceType/text()')[0]
+		deviceinstance = xpath(e, 'DeviceInstance/text()')[0]
+		devicetype = int(xpath(e, 'DeviceType/text()')[0])
 		create_node(container, 'ClassAndVrmInstance',
 			'{}:{}'.format(servicetype, deviceinstance), 's')
 		create_node(container, 'SupportMultiphase',
@@ -280,13 +282,13 @@ def migrate_cgwacs_deviceinstance(localSettings, tree, version):
 		for setting, typ in (('CustomName', 's'), ('L1ReverseEnergy', 'f'),
 				('L2ReverseEnergy', 'f'), ('L3ReverseEnergy', 'f'), 
 				('Position', 'i')):
-			old = e.xpath(setting + '/text()')
+			old = xpath(e, setting + '/text()')
 			if old:
 				create_node(container, setting, old[0], typ)
 
 		# This was renamed, because Multiphase is one word
 		create_node(container, 'IsMultiphase',
-			e.xpath('IsMultiPhase/text()')[0], 'i')
+			xpath(e, 'IsMultiPhase/text()')[0], 'i')
 
 		# Migrate piggyback settings to secondary device
 		piggy = '{}_S'.format(device)
@@ -295,25 +297,22 @@ def migrate_cgwacs_deviceinstance(localSettings, tree, version):
 			container = etree.SubElement(devices, piggy)
 
 		create_node(container, 'ClassAndVrmInstance',
-			'pvinverter:{}'.format(e.xpath('L2/DeviceInstance/text()')[0]), 's')
+			'pvinverter:{}'.format(xpath(e, 'L2/DeviceInstance/text()')[0]), 's')
 		create_node(container, 'Enabled',
-			int(e.xpath('L2/ServiceType/text()') == ["pvinverter"]), 'i')
-		create_node(container, 'Position', e.xpath('L2/Position/text()')[0], 'i')
-		cn = e.xpath('L2/CustomName/text()')
+			int(xpath(e, 'L2/ServiceType/text()') == ["pvinverter"]), 'i')
+		create_node(container, 'Position', xpath(e, 'L2/Position/text()')[0], 'i')
+		cn = xpath(e, 'L2/CustomName/text()')
 		if cn:
 			create_node(container, 'CustomName', cn[0], 's')
 
 	delete_from_tree(tree, "/Settings/CGwacs/Devices")
 
 def migrate_fronius_deviceinstance(localSettings, tree, version):
-	if version > 7:
-		return
-
 	devices = tree.getroot().find("Devices")
 	if devices is None:
 		devices = etree.SubElement(tree.getroot(), 'Devices')
 
-	inverters = tree.xpath("/Settings/Fronius/InverterIds/text()")
+	inverters = xpath(tree, "/Settings/Fronius/InverterIds/text()")
 	if inverters:
 		inverters = inverters[0].split(",")
 		for idx, inverter in enumerate(inverters):
@@ -324,9 +323,6 @@ def migrate_fronius_deviceinstance(localSettings, tree, version):
 				'pvinverter:{}'.format(20 + idx), 's')
 
 def migrate_adc_settings(localSettings, tree, version):
-	if version > 8:
-		return
-
 	tank = []
 	temp = []
 
@@ -376,7 +372,7 @@ def migrate_adc_settings(localSettings, tree, version):
 
 			for fmt in paths:
 				path = fmt % {'num': num, 'pin': pin}
-				nodes = tree.xpath(path + '/*')
+				nodes = xpath(tree, path + '/*')
 
 				for n in nodes:
 					n.getparent().remove(n)
@@ -401,29 +397,22 @@ def migrate_adc_settings(localSettings, tree, version):
 	delete_from_tree(tree, '/Settings/Temperature')
 
 def migrate_fischerpanda_autostart(localSettings, tree, version):
-	if version >= 11:
-		return
-	autostart = int(tree.xpath("/Settings/Services/FischerPandaAutoStartStop/text()") == ["1"])
+	autostart = int(xpath(tree, "/Settings/Services/FischerPandaAutoStartStop/text()") == ["1"])
 	try:
-		tree.xpath('/Settings/FischerPanda0/AutoStartEnabled')[0].text = str(autostart)
+		xpath(tree, '/Settings/FischerPanda0/AutoStartEnabled')[0].text = str(autostart)
 	except (IndexError, AttributeError):
 		pass
 	else:
 		delete_from_tree(tree, "/Settings/Services/FischerPandaAutoStartStop")
 
 def migrate_fischerpanda_to_generic_genset(localSettings, tree, version):
-	if version >= 12:
-		return
-
-	dev = tree.xpath("/Settings/FischerPanda0")
+	dev = xpath(tree, "/Settings/FischerPanda0")
 	if dev:
 		rename_node(dev[0], "Generator1")
 
 def migrate_analog_sensors_classes(localSettings, tree, version):
-	if version >= 13:
-		return
-
-	for dev in tree.xpath("/Settings/Devices/*/ClassAndVrmInstance[starts-with(text(),'analog:')]/.."):
+	taken = class_and_vrm_instances(tree)
+	for dev in xpath(tree, "/Settings/Devices/*/ClassAndVrmInstance[starts-with(text(),'analog:')]/.."):
 		# TemperatureType is used by mopeka, TemperatureType2 by dbus-adc.
 		if dev.find("FluidType") is not None or dev.find("FluidType2") is not None:
 			newClass = "tank"
@@ -434,25 +423,20 @@ def migrate_analog_sensors_classes(localSettings, tree, version):
 			print("WARN:could not determine the class of " + dev.tag)
 			continue
 
-		change_class(dev.find('ClassAndVrmInstance'), newClass)
+		change_class(dev.find('ClassAndVrmInstance'), newClass, taken)
 
 def migrate_vedirect_classes(localsettings, tree, version):
-	if version >= 13:
-		return
-
-	classAndVrmInstances = tree.xpath('/Settings/Devices/*/ClassAndVrmInstance')
+	classAndVrmInstances = xpath(tree, '/Settings/Devices/*/ClassAndVrmInstance')
+	taken = class_and_vrm_instances(tree)
 	for e in classAndVrmInstances:
 		try:
 			if e.text.startswith('com.victronenergy.'):
 				newClass = e.text.split(":")[0][len('com.victronenergy.'):]
-				change_class(e, newClass)
+				change_class(e, newClass, taken)
 		except:
 			pass
 
 def migrate_security_settings(localsettings, tree, version):
-	if version >= 14:
-		return
-
 	# defaults, just in case an unexpected exception is thrown
 	vrmPortal = VRM_PORTAL_FULL
 	securityProfile = SECURITY_PROFILE_SECURED
@@ -466,7 +450,7 @@ def migrate_security_settings(localsettings, tree, version):
 
 	# Convert VRM Logmode
 	try:
-		node = tree.xpath("/Settings/Vrmlogger/Logmode")
+		node = xpath(tree, "/Settings/Vrmlogger/Logmode")
 		if node:
 			logMode = int(node[0].text)
 
@@ -477,7 +461,7 @@ def migrate_security_settings(localsettings, tree, version):
 				# Check VRM two-communication / MqttVrm
 				twoWay = False
 				try:
-					node = tree.xpath("/Settings/Services/MqttVrm")
+					node = xpath(tree, "/Settings/Services/MqttVrm")
 					if node and int(node[0].text) == 1:
 						twoWay = True
 				except:
@@ -495,7 +479,7 @@ def migrate_security_settings(localsettings, tree, version):
 	delete_from_tree(tree, '/Settings/Services/MqttVrm')
 
 	# Set Security Profile for Remote Console on LAN
-	node = tree.xpath("/Settings/System/VncLocal")
+	node = xpath(tree, "/Settings/System/VncLocal")
 	if node and int(node[0].text) == 1:
 		if passwordSet:
 			securityProfile = SECURITY_PROFILE_WEAK
@@ -513,11 +497,11 @@ def migrate_security_settings(localsettings, tree, version):
 
 	# Merge VncInternet and VncLocal and set VRM Portal accordingly
 	try:
-		node = tree.xpath("/Settings/System/VncInternet")
+		node = xpath(tree, "/Settings/System/VncInternet")
 		if node and int(node[0].text) == 1:
 			# Remote Console v1 on VRM / VncInternet is merged with VncLocal, but on VRM it is
 			# only enabled when VRM portal is set to full.
-			create_or_update_node(tree.xpath("/Settings/System")[0], "VncLocal", 1)
+			create_or_update_node(xpath(tree, "/Settings/System")[0], "VncLocal", 1)
 			vrmPortal = VRM_PORTAL_FULL
 	except:
 		pass
@@ -532,10 +516,10 @@ def migrate_security_settings(localsettings, tree, version):
 	mqttLocal = False
 	mqttLocalInsecure = False
 	try:
-		node = tree.xpath("/Settings/Services/MqttLocal")
+		node = xpath(tree, "/Settings/Services/MqttLocal")
 		if node and int(node[0].text) == 1:
 			mqttLocal = True
-		node = tree.xpath("/Settings/Services/MqttLocalInsecure")
+		node = xpath(tree, "/Settings/Services/MqttLocalInsecure")
 		if node and int(node[0].text) == 1:
 			mqttLocalInsecure = True
 	except:
@@ -572,9 +556,7 @@ def migrate_security_settings(localsettings, tree, version):
 # tag if it has no attributes at all, since no information can be lost anyway
 # and that allows recovering the lost devices.
 def fix_broken_vrm_instance_tags(localsettings, tree, version):
-	if version >= 15:
-		return
-	nodes = tree.xpath("/Settings/Devices/*/ClassAndVrmInstance")
+	nodes = xpath(tree, "/Settings/Devices/*/ClassAndVrmInstance")
 	for node in nodes:
 		# If the node has no attributes, delete it. Nothing can be lost
 		# that isn't already lost.
@@ -584,22 +566,16 @@ def fix_broken_vrm_instance_tags(localsettings, tree, version):
 			parent.remove(node)
 
 def migrate_dess_limits(localSettings, tree, version):
-	if version >= 18:
-		return
-
 	dess = tree.getroot().find("DynamicEss")
 	if dess is not None:
-		for elem in dess.xpath("GridImportLimit|GridExportLimit|BatteryDischargeLimit|BatteryChargeLimit"):
+		for elem in xpath(dess, "GridImportLimit|GridExportLimit|BatteryDischargeLimit|BatteryChargeLimit"):
 			elem.set("type", "f")
 
 def migrate_guiv2_brief_level(localSettings, tree, version):
-	if version >= 17:
-		return
-
 	try:
 		newlevels = get_or_create_node_and_parents(tree.getroot(), "Gui2/BriefView/Level")
 
-		nodes = tree.xpath("/Settings/Gui/BriefView/Level/*")
+		nodes = xpath(tree, "/Settings/Gui/BriefView/Level/*")
 		all_default = True
 		for node in nodes:
 			value = node.text
@@ -620,37 +596,47 @@ def migrate_guiv2_brief_level(localSettings, tree, version):
 		pass
 
 def migrate_relay_manual_polarity(localSettings, tree, version):
-	if version >= 19:
-		return
 	# For all relays configured as manual, ensure that the polarity
 	# is unchanged. This is to avoid relays suddenly flipping logic
 	# when we start also using the polarity for the manual function.
 	for p in ("Relay", "Relay/_1"):
 		try:
-			if tree.xpath(f"string(/Settings/{p}/Function)") == "2":
-				tree.xpath(f"/Settings/{p}/Polarity")[0].text = "0"
+			if xpath(tree, f"string(/Settings/{p}/Function)") == "2":
+				xpath(tree, f"/Settings/{p}/Polarity")[0].text = "0"
 		except Exception as e:
 			print (e)
 
+## The migrations in the order they run, with the oldest and the newest
+# settings version they apply to. None means there is no oldest version.
+migrations = (
+	(migrate_can_profile, 1, 1),
+	(migrate_remote_support, 1, 1),
+	(migrate_mqtt, None, 2),
+	(migrate_remotesupport2, None, 3),
+	(migrate_adc, None, 5),
+	(migrate_fronius_deviceinstance, None, 7),
+	(migrate_fixup_cgwacs, None, 7),
+	(migrate_cgwacs_deviceinstance, None, 7),
+	(migrate_adc_settings, None, 8),
+	(migrate_fischerpanda_autostart, None, 10),
+	(migrate_fischerpanda_to_generic_genset, None, 11),
+	(migrate_analog_sensors_classes, None, 12),
+	(migrate_vedirect_classes, None, 12),
+	(migrate_security_settings, None, 13),
+	(fix_broken_vrm_instance_tags, None, 14),
+	(migrate_dess_limits, None, 17),
+	(migrate_guiv2_brief_level, None, 16),
+	(migrate_relay_manual_polarity, None, 18),
+)
+
+## The migrations which apply to a settings file of the given version.
+def migrations_for(version):
+	return [function for function, oldest, newest in migrations
+			if (oldest is None or version >= oldest) and version <= newest]
+
 def migrate(localSettings, tree, version):
-	migrate_can_profile(localSettings, tree, version)
-	migrate_remote_support(localSettings, tree, version)
-	migrate_mqtt(localSettings, tree, version)
-	migrate_remotesupport2(localSettings, tree, version)
-	migrate_adc(localSettings, tree, version)
-	migrate_fronius_deviceinstance(localSettings, tree, version)
-	migrate_fixup_cgwacs(localSettings, tree, version)
-	migrate_cgwacs_deviceinstance(localSettings, tree, version)
-	migrate_adc_settings(localSettings, tree, version)
-	migrate_fischerpanda_autostart(localSettings, tree, version)
-	migrate_fischerpanda_to_generic_genset(localSettings, tree, version)
-	migrate_analog_sensors_classes(localSettings, tree, version)
-	migrate_vedirect_classes(localSettings, tree, version)
-	migrate_security_settings(localSettings, tree, version)
-	fix_broken_vrm_instance_tags(localSettings, tree, version)
-	migrate_dess_limits(localSettings, tree, version)
-	migrate_guiv2_brief_level(localSettings, tree, version)
-	migrate_relay_manual_polarity(localSettings, tree, version)
+	for function in migrations_for(version):
+		function(localSettings, tree, version)
 
 def cleanup_settings(tree):
 	""" Clean up device-specific settings. Used when restoring settings
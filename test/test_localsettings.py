@@ -11,6 +11,10 @@ import time
 import platform
 import dbus
 import copy
+import ctypes
+import signal
+import json
+import shutil
 from dbus.mainloop.glib import DBusGMainLoop
 from gi.repository import GLib
 import os
@@ -19,20 +23,27 @@ import os
 here = os.path.dirname(__file__)
 sys.path.insert(1, os.path.join(here, '../ext/velib_python'))
 from vedbus import VeDbusItemImport
+sys.path.insert(1, os.path.join(here, '..'))
+from localsettings import SaveScheduler
 
 logger = logging.getLogger(__file__)
 
 class LocalSettingsTest(unittest.TestCase):
+	# extra command line arguments for localsettings
+	localSettingsArgs = []
+
 	def setUp(self):
 		self._dataDir = os.path.join(here, "data/conf")
 		if not os.path.exists(self._dataDir):
 			os.makedirs(self._dataDir)
 		self._settingsFile = self._dataDir + '/settings.xml'
+		self._shardsDir = self._dataDir + '/settings'
 		# Always start with a fresh and running instance of localsettings
 		try:
 			os.remove(self._settingsFile)
 		except OSError:
 			pass
+		shutil.rmtree(self._shardsDir, ignore_errors=True)
 
 		self._dbus = dbus.SystemBus() if (platform.machine() == 'armv7l') else dbus.SessionBus()
 		self._dbus.add_signal_receiver(self.dbus_name_owner_changed, signal_name='NameOwnerChanged')
@@ -52,6 +63,19 @@ class LocalSettingsTest(unittest.TestCase):
 				return
 			time.sleep(0.01)
 
+	## Waits till condition returns true, fails when that takes longer than
+	# timeout seconds.
+	def waitFor(self, condition, timeout = 10):
+		deadline = time.monotonic() + timeout
+		while not condition():
+			if time.monotonic() > deadline:
+				self.fail("timed out after %s s" % timeout)
+			time.sleep(0.01)
+
+	def _settings_file_contains(self, text):
+		with open(self._settingsFile) as f:
+			return text in f.read()
+
 	def test_adding_new_setting_creates_signal(self):
 		self.add_new_setting_creates_signal('AddSetting')
 
@@ -171,6 +195,29 @@ class LocalSettingsTest(unittest.TestCase):
 		self.assertEqual(0, self._add_setting('g', 's', 0, 'i', 0, 0))
 		self.assertGreater(0, self._add_setting('g', 's', 0, 'f', 0, 0))
 
+	def test_adding_setting_below_setting_fails(self):
+		self.assertEqual(0, self._add_setting('g', 's', 0, 'i', 0, 0))
+		self.assertEqual(-4, self._add_setting('g/s', 't', 0, 'i', 0, 0))
+		self.assertEqual(-8, self._add_setting('', 'g', 0, 'i', 0, 0))
+		self.assertEqual(0, self.get_value("g/s"))
+		self.assertEqual(None, self.get_value("g/s/t"))
+
+	def test_adding_setting_with_invalid_path_fails(self):
+		self.assertEqual(-4, self._add_setting('g', 'a b', 0, 'i', 0, 0))
+		self.assertEqual(-4, self._add_setting('g/', 'x', 0, 'i', 0, 0))
+		self.assertEqual(-4, self._add_setting('g', 'x/', 0, 'i', 0, 0))
+		self.assertEqual(-4, self._add_setting('h-1', 'x', 0, 'i', 0, 0))
+		self.assertEqual(self._add_settings([{'path': 'g/a.b', 'default': 0}])[0]['error'], -4)
+		self.assertEqual(self._get_items(), {})
+
+		# Nothing was left behind which prevents saving the settings.
+		self.assertEqual(0, self._add_setting('g', 's', 1, 'i', 0, 10))
+		self.set_value('g/s', 2)
+		self.waitFor(lambda: self._settings_file_contains('>2</s>'))
+		self._stopLocalSettings()
+		self._startLocalSettings()
+		self.assertEqual(2, self.get_value("g/s"))
+
 	def get_value(self, path):
 		object = self._dbus.get_object("com.victronenergy.settings", os.path.join("/Settings", path))
 		try:
@@ -311,9 +358,638 @@ class LocalSettingsTest(unittest.TestCase):
 		self.assertEqual(self.get_value("Devices/a/ClassAndVrmInstance"), "tank:1")
 		self.assertEqual(self.get_default("Devices/a/ClassAndVrmInstance"), "battery:1")
 
-	def _startLocalSettings(self):
+	def test_vrm_instance_lookup(self):
+		print("\n===Testing VRM Instance lookup ===\n")
+		definition = [
+			{"path": "Devices/a/ClassAndVrmInstance", "default": "battery:1"},
+			{"path": "Devices/b/ClassAndVrmInstance", "default": "battery:1"},
+			{"path": "Devices/c/ClassAndVrmInstance", "default": "tank:1"},
+		]
+		self._add_settings(definition)
+
+		object = self._dbus.get_object("com.victronenergy.settings", "/Settings/Devices")
+		lookup = object.get_dbus_method("LookupVrmInstance", dbus_interface="com.victronenergy.Settings")
+		self.assertEqual(lookup("battery", 2), ("b", "/Settings/Devices/b"))
+		self.assertEqual(lookup("tank", 1), ("c", "/Settings/Devices/c"))
+		self.assertEqual(lookup("tank", 2), ("", ""))
+
+		# changing the instance frees the old one
+		self.set_value("Devices/a/ClassAndVrmInstance", "battery:2")
+		self.assertEqual(self.get_value("Devices/a/ClassAndVrmInstance"), "battery:3")
+		self.assertEqual(lookup("battery", 1), ("", ""))
+		self.assertEqual(lookup("battery", 3), ("a", "/Settings/Devices/a"))
+
+		# and so does removing the device
+		object.get_dbus_method("RemoveSettings")(["b/ClassAndVrmInstance"])
+		self.assertEqual(lookup("battery", 2), ("", ""))
+		self.assertEqual(self._add_settings([{"path": "Devices/d/ClassAndVrmInstance", "default": "battery:2"}])[0]["value"], "battery:2")
+
+		# the instances loaded from the settings file are taken as well
+		self.waitFor(lambda: self._settings_file_contains('<d>'))
+		self._stopLocalSettings()
+		self._startLocalSettings()
+		self.assertEqual(self._add_settings([{"path": "Devices/e/ClassAndVrmInstance", "default": "battery:2"}])[0]["value"], "battery:4")
+
+	def test_journal_is_replayed(self):
+		print("\n===Testing the journal ===\n")
+		self._stopLocalSettings()
+		self._startLocalSettings(["--journal"])
+
+		journal = self._settingsFile + ".journal"
+		self.assertEqual(0, self._add_setting('g', 's', 0, 'i', 0, 0))
+		self.assertEqual(0, self._add_setting('g', 'r', 0, 'i', 0, 0))
+		self.assertEqual(0, self.set_value("g/s", 5))
+		object = self._dbus.get_object("com.victronenergy.settings", "/Settings")
+		self.assertEqual([0], object.get_dbus_method("RemoveSettings")(["g/r"]))
+
+		for x in range(0, 50):
+			if os.path.exists(journal) and b'"removed"' in open(journal, 'rb').read():
+				break
+			time.sleep(0.01)
+		self.assertNotIn(b"<s ", open(self._settingsFile, 'rb').read())
+
+		# localsettings is killed, so the journal is not compacted
+		self._stopLocalSettings()
+		self._startLocalSettings()
+
+		self.assertFalse(os.path.exists(journal))
+		self.assertEqual(self.get_value("g/s"), 5)
+		self.assertEqual(self.get_value("g/r"), None)
+
+		# The journal is compacted when localsettings quits.
+		self._stopLocalSettings()
+		self._startLocalSettings(["--journal"])
+		self.assertEqual(0, self.set_value("g/s", 6))
+		object = self._dbus.get_object("com.victronenergy.settings", "/")
+		object.Flush(dbus_interface="com.victronenergy.BusItem")
+		self.assertTrue(os.path.exists(journal))
+		self._stopLocalSettings(terminate = True)
+		self.assertFalse(os.path.exists(journal))
+		self.assertTrue(self._settings_file_contains('>6</s>'))
+
+	def test_journal_keeps_the_order_of_changes(self):
+		self._stopLocalSettings()
+		self._startLocalSettings(["--journal", "--save-quiet-period=10", "--save-max-deferral=10"])
+
+		# Within a single save, x is a group, then a setting, then a group
+		# again, so the records must be replayed in the order of the changes.
+		settings = self._dbus.get_object("com.victronenergy.settings", "/Settings")
+		remove_settings = settings.get_dbus_method("RemoveSettings", dbus_interface="com.victronenergy.Settings")
+		self.assertEqual(0, self._add_setting('x', 'y', 1, 'i', 0, 10))
+		self.assertEqual([0], remove_settings(['x/y']))
+		self.assertEqual(0, self._add_setting('', 'x', 2, 'i', 0, 10))
+		self.assertEqual([0], remove_settings(['x']))
+		self.assertEqual(0, self._add_setting('x', 'y', 3, 'i', 0, 10))
+		object = self._dbus.get_object("com.victronenergy.settings", "/")
+		object.Flush(dbus_interface="com.victronenergy.BusItem")
+
+		# localsettings is killed, so the journal is replayed at startup.
+		self._stopLocalSettings()
+		self._startLocalSettings(["--journal"])
+		self.assertEqual(self.get_value("x/y"), 3)
+
+	def test_items_changed(self):
+		self._itemsChanged = []
+		receiver = self._dbus.add_signal_receiver(self._itemsChanged.append, signal_name='ItemsChanged',
+			dbus_interface='com.victronenergy.BusItem', path='/')
+
+		self._add_settings([
+			{'path': 'g/a', 'default': 1},
+			{'path': 'g/b', 'default': 'x'},
+		])
+		while not self._itemsChanged:
+			GLib.MainContext.default().iteration(True)
+		receiver.remove()
+
+		self.assertEqual(len(self._itemsChanged), 1)
+		changes = self._itemsChanged[0]
+		self.assertEqual(sorted(changes.keys()), ['/Settings/g/a', '/Settings/g/b'])
+		self.assertEqual(changes['/Settings/g/a']['Value'], 1)
+		self.assertEqual(changes['/Settings/g/b']['Text'], 'x')
+
+	def test_group_items_changed(self):
+		self._add_settings([
+			{'path': 'g/a', 'default': 1},
+			{'path': 'g/h/b', 'default': 2},
+			{'path': 'other/c', 'default': 3},
+		])
+		group = self._dbus.get_object("com.victronenergy.settings", "/Settings/g")
+		self.assertEqual(group.EnableItemsChanged(True, dbus_interface='com.victronenergy.Settings'), 0)
+
+		itemsChanged = []
+		receiver = self._dbus.add_signal_receiver(itemsChanged.append, signal_name='ItemsChanged',
+			dbus_interface='com.victronenergy.BusItem', path='/Settings/g')
+		settings = self._dbus.get_object("com.victronenergy.settings", "/Settings")
+		settings.SetValues({'g/a': 4, 'g/h/b': 5, 'other/c': 6}, dbus_interface='com.victronenergy.Settings')
+		while not itemsChanged:
+			GLib.MainContext.default().iteration(True)
+
+		self.assertEqual(len(itemsChanged), 1)
+		self.assertEqual(sorted(itemsChanged[0].keys()), ['/Settings/g/a', '/Settings/g/h/b'])
+		self.assertEqual(itemsChanged[0]['/Settings/g/h/b']['Value'], 5)
+
+		# The watched group stays when its settings are removed.
+		self.assertEqual(group.RemoveSettings(['a', 'h/b']), [0, 0])
+		while len(itemsChanged) < 2:
+			GLib.MainContext.default().iteration(True)
+		receiver.remove()
+		self.assertEqual(sorted(itemsChanged[1].keys()), ['/Settings/g/a', '/Settings/g/h/b'])
+		self.assertIn('node name="g"', settings.Introspect())
+
+		group.EnableItemsChanged(False, dbus_interface='com.victronenergy.Settings')
+		self.assertNotIn('node name="g"', settings.Introspect())
+
+	def test_watched_empty_group_is_not_saved(self):
+		self._add_settings([{'path': 'g/a', 'default': 1}, {'path': 'h/b', 'default': 2}])
+		group = self._dbus.get_object("com.victronenergy.settings", "/Settings/g")
+		group.EnableItemsChanged(True, dbus_interface='com.victronenergy.Settings')
+		self.assertEqual(group.RemoveSettings(['a']), [0])
+		self.assertEqual(self.get_value('g'), {})
+		object = self._dbus.get_object("com.victronenergy.settings", "/")
+		object.Flush(dbus_interface="com.victronenergy.BusItem")
+		self.assertFalse(self._settings_file_contains('<g'))
+
+		# Neither in the startup snapshot written on shutdown.
+		self._stopLocalSettings(terminate = True)
+		self._startLocalSettings()
+		object = self._dbus.get_object("com.victronenergy.settings", "/")
+		self.assertNotIn('Parse', object.GetStartupProfile(dbus_interface="com.victronenergy.BusItem"))
+		self.assertEqual(self.get_value('g'), None)
+		self.assertEqual(self.get_value('h/b'), 2)
+
+	def test_group_items_changed_per_client(self):
+		self._add_settings([{'path': 'g/a', 'default': 1}])
+		bus = dbus.SystemBus(private=True) if (platform.machine() == 'armv7l') else dbus.SessionBus(private=True)
+		bus.set_exit_on_disconnect(False)
+		group = self._dbus.get_object("com.victronenergy.settings", "/Settings/g")
+		otherGroup = bus.get_object("com.victronenergy.settings", "/Settings/g")
+		group.EnableItemsChanged(True, dbus_interface='com.victronenergy.Settings')
+		otherGroup.EnableItemsChanged(True, dbus_interface='com.victronenergy.Settings')
+
+		# Another client disabling it doesn't affect this one.
+		otherGroup.EnableItemsChanged(False, dbus_interface='com.victronenergy.Settings')
+		itemsChanged = []
+		receiver = self._dbus.add_signal_receiver(itemsChanged.append, signal_name='ItemsChanged',
+			dbus_interface='com.victronenergy.BusItem', path='/Settings/g')
+		self.set_value('g/a', 2)
+		deadline = time.monotonic() + 10
+		while not itemsChanged and time.monotonic() < deadline:
+			GLib.MainContext.default().iteration(False)
+			time.sleep(0.01)
+		receiver.remove()
+		self.assertEqual(list(itemsChanged[0].keys()), ['/Settings/g/a'])
+
+		# The group is kept while any client watches it, its watch is gone
+		# once the client leaves the bus.
+		otherGroup.EnableItemsChanged(True, dbus_interface='com.victronenergy.Settings')
+		group.EnableItemsChanged(False, dbus_interface='com.victronenergy.Settings')
+		self.assertEqual(group.RemoveSettings(['a']), [0])
+		self.assertEqual(self.get_value('g'), {})
+		bus.close()
+		self.waitFor(lambda: self.get_value('g') is None)
+
+	def test_no_properties_changed(self):
+		self._stopLocalSettings()
+		self._startLocalSettings(["--no-properties-changed"])
+
+		itemsChanged = []
+		propertiesChanged = []
+		receivers = [
+			self._dbus.add_signal_receiver(itemsChanged.append, signal_name='ItemsChanged'),
+			self._dbus.add_signal_receiver(propertiesChanged.append, signal_name='PropertiesChanged'),
+		]
+		self._add_setting('g', 's', 1, 'i', 0, 10)
+		while not itemsChanged:
+			GLib.MainContext.default().iteration(True)
+		for receiver in receivers:
+			receiver.remove()
+
+		self.assertIn('/Settings/g/s', itemsChanged[0])
+		self.assertEqual(propertiesChanged, [])
+
+	def test_get_set_values(self):
+		self._add_settings([
+			{'path': 'g/i', 'default': 1, 'min': 0, 'max': 10},
+			{'path': 'g/s', 'default': 'x'},
+		])
+		object = self._dbus.get_object("com.victronenergy.settings", "/Settings/g")
+		get_values = object.get_dbus_method("GetValues", dbus_interface="com.victronenergy.Settings")
+		set_values = object.get_dbus_method("SetValues", dbus_interface="com.victronenergy.Settings")
+
+		self.assertEqual(get_values(['i', 's', 'x']), {'i': 1, 's': 'x'})
+
+		# The values are set before SetValues replies, but saved later.
+		self.assertEqual(set_values({'i': 5, 's': 'y', 'x': 1}), {'i': 0, 's': 0, 'x': -1})
+		self.assertEqual(set_values({'i': 11}), {'i': -1})
+		self.assertEqual(get_values(['i', 's']), {'i': 5, 's': 'y'})
+		self.waitFor(lambda: self._settings_file_contains('>5</i>') and self._settings_file_contains('>y</s>'))
+
+		self._stopLocalSettings()
+		self._startLocalSettings()
+		self.assertEqual(self.get_value("g/i"), 5)
+		self.assertEqual(self.get_value("g/s"), 'y')
+
+	def test_security_profile_access(self):
+		self._add_settings([
+			{'path': 'System/SecurityProfile', 'default': 1},
+			{'path': 'System/Other', 'default': 1},
+		])
+		# Only venus-platform may change the security profile.
+		self.assertEqual(self.set_value("System/SecurityProfile", 2), -1)
+		self.assertEqual(self.set_value("System/SecurityProfile", 2), -1)
+		self.assertEqual(self.get_value("System/SecurityProfile"), 1)
+
+		group = self._dbus.get_object("com.victronenergy.settings", "/Settings/System")
+		set_values = group.get_dbus_method("SetValues", dbus_interface="com.victronenergy.Settings")
+		self.assertEqual(set_values({'SecurityProfile': 2, 'Other': 2}), {'SecurityProfile': -1, 'Other': 0})
+		self.assertEqual(self.get_value("System/SecurityProfile"), 1)
+		self.assertEqual(self.get_value("System/Other"), 2)
+
+		self.assertEqual(group.SetDefault(), 0)
+		self.assertEqual(self.get_value("System/Other"), 1)
+
+		self._add_settings([{'path': 'Devices/a/ClassAndVrmInstance', 'default': 'battery:1'}])
+		object = self._dbus.get_object("com.victronenergy.settings", "/Settings/Devices/a/ClassAndVrmInstance")
+		self.assertEqual(object.SetDefault(), -1)
+
+	def test_remove_during_set_value(self):
+		self._stopLocalSettings()
+		self._startLocalSettings(["--journal"])
+		self._add_settings([{'path': 'System/SecurityProfile', 'default': 1}])
+
+		# The process of a new sender is looked up before the setting is
+		# changed. localsettings is stopped till both calls are queued, so the
+		# setting is removed in the meantime.
+		bus = dbus.SystemBus(private=True) if (platform.machine() == 'armv7l') else dbus.SessionBus(private=True)
+		bus.set_exit_on_disconnect(False)
+		setting = bus.get_object("com.victronenergy.settings", "/Settings/System/SecurityProfile", introspect=False)
+		settings = bus.get_object("com.victronenergy.settings", "/Settings", introspect=False)
+		replies = []
+		libc = ctypes.CDLL(None)
+		name = ctypes.create_string_buffer(16)
+		libc.prctl(16, name) # PR_GET_NAME
+		libc.prctl(15, b"venus-platform") # PR_SET_NAME
+		os.kill(self.sp.pid, signal.SIGSTOP)
+		try:
+			setting.SetValue(2, dbus_interface="com.victronenergy.BusItem",
+								reply_handler=replies.append, error_handler=replies.append)
+			settings.RemoveSettings(['System/SecurityProfile'], dbus_interface="com.victronenergy.Settings",
+								reply_handler=replies.append, error_handler=replies.append)
+			# The bus daemon passed both calls on when it replies to this.
+			bus.name_has_owner("com.victronenergy.settings")
+			os.kill(self.sp.pid, signal.SIGCONT)
+			deadline = time.monotonic() + 10
+			while len(replies) < 2 and time.monotonic() < deadline:
+				GLib.MainContext.default().iteration(False)
+				time.sleep(0.01)
+		finally:
+			os.kill(self.sp.pid, signal.SIGCONT)
+			libc.prctl(15, name)
+			bus.close()
+		self.assertEqual(replies, [[0], -1])
+
+		object = self._dbus.get_object("com.victronenergy.settings", "/")
+		object.Flush(dbus_interface="com.victronenergy.BusItem")
+		self._stopLocalSettings()
+		self._startLocalSettings(["--journal"])
+		self.assertEqual(self.get_value("System/SecurityProfile"), None)
+
+	def test_change_log(self):
+		self.updateSettingsStamp()
+		self._add_settings([{'path': 'g/s', 'default': 0}])
+		self.waitForSettingsStored()
+		self._stopLocalSettings()
+		self._startLocalSettings(['--change-log-interval=60'], stderr=subprocess.PIPE)
+		for i in range(1, 6):
+			self.set_value("g/s", i)
+
+		# The suppressed changes are logged when quitting.
+		self.sp.terminate()
+		log = self.sp.stderr.read().decode()
+		self.sp.stderr.close()
+		self.sp.wait()
+		self.assertIn('Setting /Settings/g/s changed. Old: 0, New: 1', log)
+		self.assertIn('Setting /Settings/g/s changed 4 times, last value 5', log)
+		self.assertEqual(log.count('Setting /Settings/g/s changed'), 2)
+
+	def test_cached_values_follow_changes(self):
+		self._add_settings([
+			{'path': 'g/a', 'default': 1},
+			{'path': 'g/h/b', 'default': 2},
+		])
+		group = self._dbus.get_object("com.victronenergy.settings", "/Settings/g")
+		self.assertEqual(self._get_items()['/Settings/g/h/b']['Value'], 2)
+		self.assertEqual(group.GetValue(), {'a': 1, 'h/b': 2})
+		self.assertEqual(group.GetText(), {'a': '1', 'h/b': '2'})
+
+		self.set_value("g/h/b", 3)
+		self.assertEqual(self._get_items()['/Settings/g/h/b']['Value'], 3)
+		self.assertEqual(group.GetValue(), {'a': 1, 'h/b': 3})
+		self.assertEqual(group.GetText(), {'a': '1', 'h/b': '3'})
+
+		self._add_settings([{'path': 'g/c', 'default': 4}])
+		self.assertEqual(group.GetValue(), {'a': 1, 'c': 4, 'h/b': 3})
+		self.assertEqual([0], group.RemoveSettings(['a']))
+		self.assertEqual(group.GetValue(), {'c': 4, 'h/b': 3})
+		self.assertNotIn('/Settings/g/a', self._get_items())
+
+	def test_get_items_paged(self):
+		self._add_settings([{'path': path, 'default': 1} for path in
+			['g/a', 'g/h/b', 'g/h/c', 'g/i/d', 'g/e', 'g/f', 'other/x']])
+		group = self._dbus.get_object("com.victronenergy.settings", "/Settings/g")
+		items = group.GetItems()
+		self.assertEqual(sorted(items.keys()), ['/Settings/g/a', '/Settings/g/e', '/Settings/g/f',
+			'/Settings/g/h/b', '/Settings/g/h/c', '/Settings/g/i/d'])
+
+		pages = []
+		cursor = ''
+		while True:
+			page, cursor = group.GetItemsPaged(cursor, 2)
+			pages.append(page)
+			if not cursor:
+				break
+		self.assertEqual([len(page) for page in pages], [2, 2, 2])
+		self.assertEqual({path: value for page in pages for path, value in page.items()}, items)
+
+		# Paging continues after the cursor, even when it was removed.
+		page, cursor = group.GetItemsPaged('', 3)
+		group.RemoveSettings([cursor[len('/Settings/g/'):]])
+		rest, cursor = group.GetItemsPaged(cursor, 0)
+		self.assertEqual(cursor, '')
+		self.assertEqual(len(page) + len(rest), 6)
+		self.assertEqual(set(page) & set(rest), set())
+
+		root = self._dbus.get_object("com.victronenergy.settings", "/")
+		self.assertEqual(len(root.GetItemsPaged('', 0)[0]), len(self._get_items()))
+		with self.assertRaises(dbus.exceptions.DBusException):
+			group.GetItemsPaged('/Settings/other/x', 1)
+
+	def test_startup_snapshot(self):
+		snapshot = self._settingsFile + '.snapshot'
+		self.updateSettingsStamp()
+		self.assertEqual(0, self._add_setting('g', 's', 3, 'i', 0, 10))
+		self.waitForSettingsStored()
+
+		# The snapshot is written on shutdown as well, but not when killed.
+		self._stopLocalSettings()
+		self._startLocalSettings()
+		self.assertEqual(self.get_value("g/s"), 3)
+		for x in range(0, 50):
+			if os.path.exists(snapshot):
+				break
+			time.sleep(0.01)
+
+		# A corrupt snapshot is ignored.
+		self._stopLocalSettings()
+		with open(snapshot, 'r+b') as f:
+			f.seek(-4, os.SEEK_END)
+			f.write(b'xxxx')
+		self._startLocalSettings()
+		self.assertEqual(self.get_value("g/s"), 3)
+
+		# So is a snapshot for another settings file.
+		self._stopLocalSettings()
+		with open(self._settingsFile) as f:
+			data = f.read()
+		with open(self._settingsFile, 'w') as f:
+			f.write(data.replace('>3</s>', '>4</s>'))
+		self._startLocalSettings()
+		self.assertEqual(self.get_value("g/s"), 4)
+
+		# And the snapshot is used when nothing changed.
+		self._stopLocalSettings()
+		self._startLocalSettings()
+		self.assertEqual(self.get_value("g/s"), 4)
+
+	def test_startup_snapshot_after_add(self):
+		self.assertEqual(0, self._add_setting('g', 's', 3, 'i', 0, 10))
+		self.assertEqual(self._add_settings([{'path': 'g/t', 'default': 'x'}])[0]['error'], 0)
+
+		# The settings added over D-Bus are in the snapshot written on a
+		# clean shutdown, so it is used by the next start.
+		self._stopLocalSettings(terminate = True)
+		self._startLocalSettings()
+		object = self._dbus.get_object("com.victronenergy.settings", "/")
+		profile = object.GetStartupProfile(dbus_interface="com.victronenergy.BusItem")
+		self.assertIn('Snapshot', profile)
+		self.assertNotIn('Parse', profile)
+		self.assertEqual(self.get_value("g/s"), 3)
+		self.assertEqual(self.get_value("g/t"), 'x')
+
+	def test_settings_dir(self):
+		settingsDir = os.path.join(here, "data/settings.d")
+		if not os.path.exists(settingsDir):
+			os.makedirs(settingsDir)
+		defaults = os.path.join(settingsDir, "test")
+		cache = self._settingsFile + '.defaults'
+		with open(defaults, 'w') as f:
+			f.write('# test settings\nd/a 1 i 0 10\nd/b "x" s # string\n')
+		if os.path.exists(cache):
+			os.remove(cache)
+
+		self._stopLocalSettings()
+		self._startLocalSettings(["--settings-dir=" + settingsDir])
+		self.assertEqual(self.get_value("d/a"), 1)
+		self.assertEqual(self.get_value("d/b"), 'x')
+		self.waitFor(lambda: os.path.exists(cache) and self._settings_file_contains('>1</a>'))
+
+		# The cache is outdated when the contents change, even if the size
+		# and modification time are still the same.
+		self._stopLocalSettings()
+		st = os.stat(defaults)
+		with open(defaults, 'w') as f:
+			f.write('# test settings\nd/a 2 i 0 10\nd/b "x" s # string\n')
+		os.utime(defaults, ns=(st.st_atime_ns, st.st_mtime_ns))
+		self._startLocalSettings(["--settings-dir=" + settingsDir])
+		self.assertEqual(self.get_value("d/a"), 1)
+		self.assertEqual(self.get_default("d/a"), 2)
+
+		# A definition with another type than the setting is skipped, but a
+		# later one of the same type is used. So are the definitions after
+		# an invalid one.
+		self._stopLocalSettings()
+		with open(defaults, 'w') as f:
+			f.write('d/a 3.0 f 0 10\nd/a 4 i 0 10\nd/c 20 i 0 10\nd/e 1 i 0 10\n')
+		self._startLocalSettings(["--settings-dir=" + settingsDir])
+		self.assertEqual(self.get_value("d/a"), 1)
+		self.assertEqual(self.get_default("d/a"), 4)
+		self.assertEqual(self.get_value("d/c"), None)
+		self.assertEqual(self.get_value("d/e"), 1)
+
+	def test_startup_profile(self):
+		object = self._dbus.get_object("com.victronenergy.settings", "/")
+		profile = object.GetStartupProfile(dbus_interface="com.victronenergy.BusItem")
+		for phase in ['UniqueId', 'Objects', 'SettingsDir', 'CheckSecurity', 'ClaimName']:
+			self.assertIn(phase, profile)
+		self.assertTrue(all(duration >= 0 for duration in profile.values()))
+		phases = sum(duration for phase, duration in profile.items() if phase != 'Total')
+		self.assertAlmostEqual(profile['Total'], phases, places=3)
+
+	def test_stats(self):
+		object = self._dbus.get_object("com.victronenergy.settings", "/")
+		get_stats = object.get_dbus_method("GetStats", dbus_interface="com.victronenergy.BusItem")
+		saved = lambda: get_stats(False)['Saves']['Count'] >= 1
+
+		# The save is accounted for when the writer thread is done, so
+		# only reset the statistics when no save is pending anymore.
+		get_stats(True)
+		self._add_setting('g', 's', 1, 'i', 0, 10)
+		self.waitFor(saved)
+		get_stats(True)
+
+		self.set_value('g/s', 2)
+		self.get_value('g/s')
+		self.get_value('g/s')
+		self.waitFor(saved)
+		stats = get_stats(True)
+		self.assertEqual(stats['Methods']['GetValue']['Count'], 2)
+		self.assertEqual(stats['Methods']['SetValue']['Count'], 1)
+		self.assertEqual(sum(stats['Methods']['GetValue']['Histogram']), 2)
+		self.assertEqual(len(stats['Methods']['GetValue']['Histogram']), len(stats['LatencyBuckets']) + 1)
+		self.assertGreaterEqual(stats['Senders'][self._dbus.get_unique_name()]['Count'], 4)
+		self.assertGreaterEqual(stats['Groups']['/Settings/g']['Count'], 3)
+		self.assertEqual(stats['Signals']['PropertiesChanged'], 1)
+		self.assertEqual(stats['Saves']['Count'], 1)
+		self.assertGreater(stats['Saves']['Bytes'], 0)
+		# Taking the snapshot on the mainloop is part of the serializing.
+		self.assertLessEqual(stats['Saves']['SnapshotMaxTime'], stats['Saves']['SnapshotTime'])
+		self.assertLessEqual(stats['Saves']['SnapshotTime'], stats['Saves']['SerializeTime'])
+
+		# The statistics were reset, except for the GetStats call itself.
+		stats = get_stats(False)
+		self.assertEqual(list(stats['Methods'].keys()), ['GetStats'])
+		self.assertEqual(stats['Methods']['GetStats']['Count'], 1)
+		self.assertEqual(stats['Saves']['Count'], 0)
+
+	def test_flush(self):
+		self._stopLocalSettings()
+		self._startLocalSettings(["--save-quiet-period=10", "--save-max-deferral=10"])
+		self._add_setting('g', 's', 1, 'i', 0, 10)
+		object = self._dbus.get_object("com.victronenergy.settings", "/")
+		object.Flush(dbus_interface="com.victronenergy.BusItem")
+		self.assertTrue(self._settings_file_contains('>1</s>'))
+
+		self.set_value('g/s', 2)
+		time.sleep(0.2)
+		self.assertFalse(self._settings_file_contains('>2</s>'))
+		object.Flush(dbus_interface="com.victronenergy.BusItem")
+		self.assertTrue(self._settings_file_contains('>2</s>'))
+
+	def _manifest(self):
+		with open(os.path.join(self._shardsDir, 'manifest.json')) as f:
+			return json.load(f)
+
+	def test_sharded_storage(self):
+		self._add_setting('g', 's', 1, 'i', 0, 10)
+		self._add_setting('h', 's', 2, 'i', 0, 10)
+		object = self._dbus.get_object("com.victronenergy.settings", "/")
+		object.Flush(dbus_interface="com.victronenergy.BusItem")
+		with open(self._settingsFile) as f:
+			stale = f.read()
+
+		# The settings file is converted to shards.
+		self._stopLocalSettings()
+		self._startLocalSettings(["--sharded"])
+		self.assertFalse(os.path.exists(self._settingsFile))
+		self.assertEqual(self.get_value("g/s"), 1)
+		self.assertEqual(sorted(self._manifest()['shards']), ['Devices', 'g', 'h'])
+
+		# Only the changed shard is written, also by the first save after the
+		# conversion.
+		shards = self._manifest()['shards']
+		self.set_value('g/s', 3)
+		object = self._dbus.get_object("com.victronenergy.settings", "/")
+		object.Flush(dbus_interface="com.victronenergy.BusItem")
+		manifest = self._manifest()
+		self.assertNotEqual(manifest['shards']['g'], shards['g'])
+		self.assertEqual(manifest['shards']['h'], shards['h'])
+		self.assertEqual(manifest['shards']['Devices'], shards['Devices'])
+		shards = manifest['shards']
+		self.set_value('g/s', 4)
+		object.Flush(dbus_interface="com.victronenergy.BusItem")
+		manifest = self._manifest()
+		self.assertNotEqual(manifest['shards']['g'], shards['g'])
+		self.assertEqual(manifest['shards']['h'], shards['h'])
+		self.assertEqual(sorted(os.listdir(self._shardsDir)), sorted(list(manifest['shards'].values()) + ['manifest.json']))
+
+		# A settings file left behind next to the shards is removed.
+		self._stopLocalSettings()
+		with open(self._settingsFile, 'w') as f:
+			f.write(stale)
+		self._startLocalSettings(["--sharded"])
+		self.assertFalse(os.path.exists(self._settingsFile))
+		self.assertEqual(self.get_value("g/s"), 4)
+
+		# The startup snapshot is not used when a shard changed.
+		self._stopLocalSettings(terminate = True)
+		shard = os.path.join(self._shardsDir, self._manifest()['shards']['g'])
+		with open(shard) as f:
+			data = f.read()
+		with open(shard, 'w') as f:
+			f.write(data.replace('>4</s>', '>5</s>'))
+		self._startLocalSettings(["--sharded"])
+		self.assertEqual(self.get_value("g/s"), 5)
+
+		# The settings can be exported as a single file.
+		export = os.path.join(self._dataDir, 'export.xml')
+		subprocess.check_call([sys.executable, os.path.join(here, "..", "localsettings.py"),
+								"--path=" + self._dataDir, "--export=" + export], stdout=subprocess.DEVNULL)
+		with open(export) as f:
+			data = f.read()
+		os.remove(export)
+		self.assertIn('>5</s>', data)
+		self.assertIn('>2</s>', data)
+
+		# And are converted back to a single settings file.
+		self._stopLocalSettings()
+		stale = os.path.join(self._dataDir, 'stale')
+		shutil.copytree(self._shardsDir, stale)
+		self._startLocalSettings()
+		self.assertFalse(os.path.exists(self._shardsDir))
+		self.assertEqual(self.get_value("g/s"), 5)
+		self.assertEqual(self.get_value("h/s"), 2)
+
+		# Shards left behind next to the settings file are removed.
+		self.set_value('g/s', 6)
+		self.waitFor(lambda: self._settings_file_contains('>6</s>'))
+		self._stopLocalSettings()
+		os.rename(stale, self._shardsDir)
+		self._startLocalSettings()
+		self.assertFalse(os.path.exists(self._shardsDir))
+		self.assertEqual(self.get_value("g/s"), 6)
+
+	def test_introspect(self):
+		self._add_setting('g', 's', 1, 'i', 0, 10)
+		object = self._dbus.get_object("com.victronenergy.settings", "/Settings")
+		data = object.Introspect(dbus_interface=dbus.INTROSPECTABLE_IFACE)
+		self.assertIn('<node name="g"/>', data)
+		self.assertIn('<method name="AddSetting">', data)
+
+		# The introspection data is cached, but follows the children.
+		self._add_setting('h', 's', 1, 'i', 0, 10)
+		self._add_setting('g', 't', 1, 'i', 0, 10)
+		data = object.Introspect(dbus_interface=dbus.INTROSPECTABLE_IFACE)
+		self.assertIn('<node name="h"/>', data)
+		object.RemoveSettings(['h/s'], dbus_interface="com.victronenergy.Settings")
+		data = object.Introspect(dbus_interface=dbus.INTROSPECTABLE_IFACE)
+		self.assertNotIn('<node name="h"/>', data)
+		self.assertIn('<node name="g"/>', data)
+
+		group = self._dbus.get_object("com.victronenergy.settings", "/Settings/g")
+		self.assertIn('<node name="t"/>', group.Introspect(dbus_interface=dbus.INTROSPECTABLE_IFACE))
+
+		object = self._dbus.get_object("com.victronenergy.settings", "/Settings/g/s")
+		data = object.Introspect(dbus_interface=dbus.INTROSPECTABLE_IFACE)
+		self.assertIn('<method name="GetValue">', data)
+
+		object = self._dbus.get_object("com.victronenergy.settings", "/Settings/Nonexisting", introspect=False)
+		with self.assertRaises(dbus.exceptions.DBusException) as cm:
+			object.GetValue(dbus_interface="com.victronenergy.BusItem")
+		self.assertEqual(cm.exception.get_dbus_name(), "org.freedesktop.DBus.Error.UnknownObject")
+
+	def _startLocalSettings(self, args = [], stderr = None):
 		self._isUp = False
-		self.sp = subprocess.Popen([sys.executable, os.path.join(here, "..", "localsettings.py"), "--path=" + self._dataDir, "--no-delay"], stdout=subprocess.PIPE)
+		self.sp = subprocess.Popen([sys.executable, os.path.join(here, "..", "localsettings.py"), "--path=" + self._dataDir, "--no-delay"] + self.localSettingsArgs + args, stdout=subprocess.PIPE, stderr=stderr)
 
 		# wait for it to be up and running
 		while not self._isUp:
@@ -322,9 +998,12 @@ class LocalSettingsTest(unittest.TestCase):
 				main_context.iteration(False)
 
 
-	def _stopLocalSettings(self):
+	def _stopLocalSettings(self, terminate = False):
 		self.sp.stdout.close()
-		self.sp.kill()
+		if terminate:
+			self.sp.terminate()
+		else:
+			self.sp.kill()
 		self.sp.wait()
 
 	def _add_setting(self, group, setting, value, type, minimum, maximum, rpc_name='AddSetting'):
@@ -351,6 +1030,90 @@ class LocalSettingsTest(unittest.TestCase):
 		if name == "com.victronenergy.settings" and newowner != "":
 			self._isUp = True
 
+# Run all tests again with the settings exported by a single fallback object.
+class LocalSettingsVirtualTreeTest(LocalSettingsTest):
+	localSettingsArgs = ["--virtual-tree"]
+
+## Runs the timers of a SaveScheduler on a fake clock.
+class FakeTimers:
+	def __init__(self):
+		self.now = 0
+		self._timers = {}
+		self._nextId = 1
+
+	def add(self, interval, callback):
+		self._timers[self._nextId] = (self.now + interval / 1000, callback)
+		self._nextId += 1
+		return self._nextId - 1
+
+	def remove(self, id):
+		del self._timers[id]
+
+	## Advances the clock to when, firing the timers which are due.
+	def advance(self, when):
+		while self._timers:
+			id, (due, callback) = min(self._timers.items(), key=lambda x: x[1][0])
+			if due > when:
+				break
+			del self._timers[id]
+			self.now = due
+			callback()
+		self.now = when
+
+class SaveSchedulerTest(unittest.TestCase):
+	def setUp(self):
+		self.timers = FakeTimers()
+		self.saves = []
+		self.scheduler = SaveScheduler(self._save, 2, clock=lambda: self.timers.now,
+					timeoutAdd=self.timers.add, sourceRemove=self.timers.remove)
+		self.scheduler.maxDeferral = 10
+		self.scheduler.minInterval = 1
+		self.scheduler.maxBackoff = 60
+
+	def _save(self):
+		self.saves.append(self.timers.now)
+		self.scheduler.saved()
+
+	## Changes the settings every interval seconds, till until.
+	def _change(self, start, until, interval = 0.5):
+		when = start
+		while when < until:
+			self.timers.advance(when)
+			self.scheduler.changed()
+			when += interval
+
+	def test_quiet_period(self):
+		self._change(0, 3)
+		self.timers.advance(100)
+		self.assertEqual(self.saves, [4.5])
+		self.assertFalse(self.scheduler.pending())
+
+	def test_max_deferral(self):
+		# The settings keep changing, so they are never quiet for long
+		# enough, but saved after the maximum deferral, which backs off.
+		self._change(0, 190)
+		self.assertEqual(self.saves, [10, 20, 40, 80, 140])
+
+		# A save after a quiet period resets the backoff.
+		self.timers.advance(300)
+		self.assertEqual(self.saves[5:], [191.5])
+		self._change(300, 320)
+		self.assertEqual(self.saves[6:], [310])
+
+	def test_flush_does_not_back_off(self):
+		# Saves which are not done by the scheduler, like Flush, don't count
+		# for the backoff.
+		for start in range(0, 15, 5):
+			self._change(start, start + 5)
+			self.scheduler.saved()
+		self._change(15, 30)
+		self.assertEqual(self.saves, [25])
+
+	def test_min_interval(self):
+		self.scheduler.quietPeriod = 0
+		self._change(0, 0.5, 0.1)
+		self.timers.advance(100)
+		self.assertEqual(self.saves, [0, 1])
 
 if __name__ == "__main__":
 	logging.basicConfig(stream=sys.stderr)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Python
+import contextlib
+import io
+import os
+import sys
+import unittest
+from lxml import etree
+
+# Local
+here = os.path.dirname(__file__)
+sys.path.insert(1, os.path.join(here, '..'))
+import migrate
+
+class MigrateTest(unittest.TestCase):
+	def _tree(self, version, xml):
+		return etree.ElementTree(etree.fromstring('<Settings version="%d">%s</Settings>' % (version, xml)))
+
+	def test_migrations_for_version(self):
+		self.assertIn(migrate.migrate_can_profile, migrate.migrations_for(1))
+		self.assertNotIn(migrate.migrate_can_profile, migrate.migrations_for(2))
+		self.assertEqual(migrate.migrations_for(12)[0], migrate.migrate_analog_sensors_classes)
+		self.assertEqual(migrate.migrations_for(18), [migrate.migrate_relay_manual_polarity])
+		self.assertEqual(migrate.migrations_for(19), [])
+
+	def test_migrations_keep_their_order(self):
+		functions = [function for function, oldest, newest in migrate.migrations]
+		self.assertEqual(migrate.migrations_for(1), functions)
+
+	def test_only_applicable_migrations_run(self):
+		xml = '<Relay><Function type="i">2</Function><Polarity type="i">1</Polarity></Relay>'
+
+		tree = self._tree(19, xml)
+		migrate.migrate(None, tree, 19)
+		self.assertEqual(tree.xpath("string(/Settings/Relay/Polarity)"), "1")
+
+		tree = self._tree(18, xml)
+		migrate.migrate(None, tree, 18)
+		self.assertEqual(tree.xpath("string(/Settings/Relay/Polarity)"), "0")
+
+	def test_xpath_variables(self):
+		tree = self._tree(12, '<Devices><a><ClassAndVrmInstance type="s">x\'y:1</ClassAndVrmInstance></a></Devices>')
+		self.assertEqual(len(migrate.xpath(tree, "/Settings/Devices/*[ClassAndVrmInstance = $value]", value = "x'y:1")), 1)
+
+	# The instances as assigned by change_class before it kept track of the
+	# taken instances: probe the tree for every candidate.
+	def _reference_change_class(self, node, classname):
+		oldClass, instance = node.text.split(":")
+		instance = int(instance)
+		node.set("default", node.get("default").replace(oldClass + ":", classname + ":"))
+		while True:
+			node.text = classname + ":" + str(instance)
+			if node.xpath("count(/Settings/Devices/*/ClassAndVrmInstance[text() = $v])", v = node.text) == 1:
+				break
+			instance += 1
+
+	def test_change_class_with_many_devices(self):
+		devices = []
+		for n in range(400):
+			if n % 4 == 0:
+				value = "solarcharger:%d" % (n % 30)
+			elif n % 4 == 1:
+				value = "com.victronenergy.solarcharger:%d" % (n % 20)
+			elif n % 4 == 2:
+				value = "analog:%d" % (n % 10)
+			else:
+				value = "com.victronenergy.tank:%d" % (n % 7)
+			device = '<d%d><ClassAndVrmInstance type="s" default="%s">%s</ClassAndVrmInstance>' % \
+						(n, value.split(":")[0] + ":0", value)
+			if value.startswith("analog:"):
+				device += '<FluidType type="i">0</FluidType>'
+			devices.append(device + '</d%d>' % n)
+		xml = '<Devices>%s</Devices>' % "".join(devices)
+
+		expected = self._tree(12, xml)
+		for node in expected.xpath("/Settings/Devices/*[FluidType]/ClassAndVrmInstance"):
+			self._reference_change_class(node, "tank")
+		for node in expected.xpath("/Settings/Devices/*/ClassAndVrmInstance[starts-with(text(), 'com.victronenergy.')]"):
+			self._reference_change_class(node, node.text.split(":")[0][len('com.victronenergy.'):])
+
+		tree = self._tree(12, xml)
+		with contextlib.redirect_stdout(io.StringIO()):
+			migrate.migrate_analog_sensors_classes(None, tree, 12)
+			migrate.migrate_vedirect_classes(None, tree, 12)
+
+		self.assertEqual(etree.tostring(tree), etree.tostring(expected))
+		tanks = tree.xpath("/Settings/Devices/*/ClassAndVrmInstance[starts-with(text(), 'tank:')]/text()")
+		self.assertEqual(len(tanks), 200)
+		self.assertEqual(len(tanks), len(set(tanks)))
+
+if __name__ == "__main__":
+	unittest.main()